@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Generate a deterministic synthetic Shiba output and indexed BAM files for benchmarks.
+
+The fixture consists of skipped exon (SE) events laid out along a single contig.
+Spliced reads are drawn from the junctions of the events, and read numbers in
+junctions.bed are those of the generated BAM files.
+
+Output directory layout:
+	experiment.tsv
+	events.txt (positional IDs of all events, one per line)
+	bams/<sample>.bam(.bai)
+	shiba/junctions/junctions.bed
+	shiba/events/EVENT_SE.txt
+	shiba/results/splicing/PSI_matrix_sample.txt
+	shiba/results/splicing/PSI_SE.txt
+"""
+import os
+import sys
+import random
+import argparse
+import pysam
+
+EXON_LENGTH = 100
+
+def get_args(argv = None):
+	parser = argparse.ArgumentParser(description = "Generate synthetic Shiba output and BAM files for benchmarks")
+	parser.add_argument("output", help = "Output directory")
+	parser.add_argument("--samples", type = int, default = 4, help = "Number of samples. Default: %(default)s")
+	parser.add_argument("--region_size", type = int, default = 100000, help = "Length of the contig. Default: %(default)s")
+	parser.add_argument("--junctions", type = int, default = 300, help = "Number of junctions (three per SE event). Default: %(default)s")
+	parser.add_argument("--reads", type = int, default = 20000, help = "Number of reads per sample. Default: %(default)s")
+	parser.add_argument("--read_length", type = int, default = 75, help = "Read length. Default: %(default)s")
+	parser.add_argument("--spliced_fraction", type = float, default = 0.3, help = "Fraction of spliced reads. Default: %(default)s")
+	parser.add_argument("--chrom", default = "chr1", help = "Contig name. Default: %(default)s")
+	parser.add_argument("--seed", type = int, default = 0, help = "Random seed. Default: %(default)s")
+	return parser.parse_args(argv)
+
+def junction_id(chrom, start, end) -> str:
+	"""
+	Junction ID used by Shiba (1-based intron start and end).
+	"""
+	return f"{chrom}:{start + 1}-{end}"
+
+def layout_events(n_events, region_size, rng) -> list:
+	"""
+	Place SE events (three exons each) along the contig without overlap.
+
+	Returns
+	- events: list
+		List of three exons [(start, end), (start, end), (start, end)] (0-based, half-open) for each event
+	"""
+	slot = region_size // max(n_events, 1)
+	if slot < 3 * EXON_LENGTH + 200:
+		raise ValueError(f"Region size {region_size} is too small for {n_events} events")
+	events = []
+	for i in range(n_events):
+		slot_start = i * slot + 50
+		slot_end = (i + 1) * slot - 50
+		# Random intron lengths within the slot
+		cuts = sorted(rng.sample(range(slot_start + EXON_LENGTH + 20, slot_end - 2 * EXON_LENGTH - 20), 2))
+		exon1 = (slot_start, slot_start + EXON_LENGTH)
+		exon2 = (cuts[0], cuts[0] + EXON_LENGTH)
+		exon3 = (max(cuts[1], exon2[1] + 20), max(cuts[1], exon2[1] + 20) + EXON_LENGTH)
+		events.append([exon1, exon2, exon3])
+	return events
+
+def write_bam(path, chrom, region_size, reads) -> None:
+	"""
+	Write reads [(start, cigar, read_length)] to a coordinate-sorted and indexed BAM file.
+	"""
+	header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": chrom, "LN": region_size}]}
+	with pysam.AlignmentFile(path, "wb", header = header) as bam:
+		for i, (start, cigar, read_length) in enumerate(sorted(reads)):
+			read = pysam.AlignedSegment()
+			read.query_name = f"r{i}"
+			read.reference_id = 0
+			read.reference_start = start
+			read.mapping_quality = 60
+			read.flag = 0
+			read.cigarstring = cigar
+			read.query_sequence = "A" * read_length
+			read.query_qualities = pysam.qualitystring_to_array("I" * read_length)
+			bam.write(read)
+	pysam.index(path)
+
+def generate(args) -> list:
+	"""
+	Generate the fixture and return positional IDs of the events.
+	"""
+	rng = random.Random(args.seed)
+	chrom = args.chrom
+	samples = [f"s{i + 1}" for i in range(args.samples)]
+	groups = ["Ref" if i < (args.samples + 1) // 2 else "Alt" for i in range(args.samples)]
+	n_events = max(1, args.junctions // 3)
+	events = layout_events(n_events, args.region_size, rng)
+	# Junctions of each event: inclusion (upstream, downstream) and exclusion
+	event_junctions = [[(e1[1], e2[0]), (e2[1], e3[0]), (e1[1], e3[0])] for e1, e2, e3 in events]
+	junctions = [junction for junctions in event_junctions for junction in junctions]
+	os.makedirs(os.path.join(args.output, "bams"), exist_ok = True)
+	read_length = args.read_length
+	counts = {}
+	psi = {}
+	for sample in samples:
+		# Inclusion level of each event differs between samples
+		inclusion = [rng.uniform(0.1, 0.9) for _ in events]
+		reads = []
+		for _ in range(args.reads):
+			if rng.random() < args.spliced_fraction:
+				k = rng.randrange(n_events)
+				j = rng.randrange(2) if rng.random() < inclusion[k] else 2
+				junc_start, junc_end = event_junctions[k][j]
+				left = rng.randint(10, read_length - 10)
+				reads.append((junc_start - left, f"{left}M{junc_end - junc_start}N{read_length - left}M", read_length))
+				counts[(sample, (junc_start, junc_end))] = counts.get((sample, (junc_start, junc_end)), 0) + 1
+			else:
+				if rng.random() < 0.5:
+					exon = events[rng.randrange(n_events)][rng.randrange(3)]
+					start = rng.randint(exon[0], exon[1] - read_length // 2)
+				else:
+					start = rng.randint(0, args.region_size - read_length)
+				start = min(start, args.region_size - read_length)
+				reads.append((start, f"{read_length}M", read_length))
+		write_bam(os.path.join(args.output, "bams", f"{sample}.bam"), chrom, args.region_size, reads)
+		for k, value in enumerate(inclusion):
+			psi[(sample, k)] = value
+	# Experiment table
+	with open(os.path.join(args.output, "experiment.tsv"), "w") as f:
+		f.write("sample\tbam\tgroup\n")
+		for sample, group in zip(samples, groups):
+			f.write(f"{sample}\t{os.path.abspath(os.path.join(args.output, 'bams', sample + '.bam'))}\t{group}\n")
+	# junctions.bed with read numbers of the generated BAM files
+	os.makedirs(os.path.join(args.output, "shiba", "junctions"), exist_ok = True)
+	with open(os.path.join(args.output, "shiba", "junctions", "junctions.bed"), "w") as f:
+		f.write("chr\tstart\tend\tID\t" + "\t".join(samples) + "\n")
+		for junc_start, junc_end in junctions:
+			values = [str(counts.get((sample, (junc_start, junc_end)), 0)) for sample in samples]
+			f.write(f"{chrom}\t{junc_start}\t{junc_end}\t{junction_id(chrom, junc_start, junc_end)}\t" + "\t".join(values) + "\n")
+	# EVENT_SE.txt
+	pos_ids = []
+	os.makedirs(os.path.join(args.output, "shiba", "events"), exist_ok = True)
+	with open(os.path.join(args.output, "shiba", "events", "EVENT_SE.txt"), "w") as f:
+		f.write("event_id\tpos_id\tgene_id\tgene_name\tstrand\tintron_a\tintron_b\tintron_c\n")
+		for k, ((e1, e2, e3), (intron_a, intron_b, intron_c)) in enumerate(zip(events, event_junctions)):
+			strand = "+" if k % 2 == 0 else "-"
+			pos_id = f"SE@{chrom}@{e2[0] + 1}-{e2[1]}@{intron_c[0]}-{intron_c[1]}"
+			pos_ids.append(pos_id)
+			f.write("\t".join([
+				f"SE_{k + 1}", pos_id, f"GENE{k + 1:05d}", f"Gene{k + 1}", strand,
+				junction_id(chrom, *intron_a), junction_id(chrom, *intron_b), junction_id(chrom, *intron_c)
+			]) + "\n")
+	# PSI matrix (some values are missing)
+	os.makedirs(os.path.join(args.output, "shiba", "results", "splicing"), exist_ok = True)
+	with open(os.path.join(args.output, "shiba", "results", "splicing", "PSI_matrix_sample.txt"), "w") as f:
+		f.write("event_id\tpos_id\t" + "\t".join(samples) + "\n")
+		for k, pos_id in enumerate(pos_ids):
+			values = ["NA" if rng.random() < 0.05 else f"{psi[(sample, k)]:.4f}" for sample in samples]
+			f.write(f"SE_{k + 1}\t{pos_id}\t" + "\t".join(values) + "\n")
+	# Differential splicing results (PSI_SE.txt) between Ref and Alt groups, with random q-values
+	with open(os.path.join(args.output, "shiba", "results", "splicing", "PSI_SE.txt"), "w") as f:
+		f.write("event_id\tpos_id\tgene_id\tgene_name\tref_PSI\talt_PSI\tdPSI\tp\tq\n")
+		for k, pos_id in enumerate(pos_ids):
+			ref_psi = sum(psi[(sample, k)] for sample, group in zip(samples, groups) if group == "Ref") / groups.count("Ref")
+			alt_psi = sum(psi[(sample, k)] for sample, group in zip(samples, groups) if group == "Alt") / max(groups.count("Alt"), 1)
+			p = rng.random() ** 3
+			f.write(f"SE_{k + 1}\t{pos_id}\tGENE{k + 1:05d}\tGene{k + 1}\t{ref_psi:.4f}\t{alt_psi:.4f}\t{alt_psi - ref_psi:.4f}\t{p:.4g}\t{min(p * 2, 1):.4g}\n")
+	with open(os.path.join(args.output, "events.txt"), "w") as f:
+		f.write("".join(f"{pos_id}\n" for pos_id in pos_ids))
+	return pos_ids
+
+def main(argv = None):
+	args = get_args(argv)
+	pos_ids = generate(args)
+	print(f"Generated {len(pos_ids)} events for {args.samples} samples in {args.output}", file = sys.stderr)
+
+if __name__ == "__main__":
+	main()
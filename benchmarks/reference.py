@@ -0,0 +1,90 @@
+"""
+Straightforward reference implementations used to check results of the optimized code.
+
+These follow the original (v0.1.7) algorithms: per-base loops, full scans of the Shiba
+tables, and no indexes or caches. They are slow on purpose and only used on benchmark fixtures.
+"""
+import numpy as np
+import pysam
+
+def median_filter(data, window_size):
+	"""
+	Median filter computing the median of each window separately.
+	"""
+	filtered_data = np.zeros_like(data)
+	half_window = window_size // 2
+	for i in range(len(data)):
+		start = max(0, i - half_window)
+		end = min(len(data), i + half_window + 1)
+		filtered_data[i] = np.median(data[start:end])
+	return filtered_data
+
+def depth(bam_path, chrom, start, end):
+	"""
+	Raw depth of the region summed over A, C, G and T of pysam count_coverage.
+	"""
+	with pysam.AlignmentFile(bam_path, "rb") as bam:
+		count = bam.count_coverage(chrom, start, end)
+	coverage = np.zeros(end - start, dtype=int)
+	for i in range(end - start):
+		coverage[i] = sum(count[j][i] for j in range(4))
+	return coverage
+
+def extract_junctions_in_region(junctions_bed, chrom, start, end, junction_list = None) -> dict:
+	"""
+	Read number of each junction in the region (or with the given IDs) by scanning junctions.bed.
+	"""
+	junctions_dict = {}
+	with open(junctions_bed) as junctions:
+		for line in junctions:
+			cols = line.rstrip("\n").split("\t")
+			if line.startswith("chr\tstart"):
+				samples = cols[4:]
+				continue
+			if junction_list:
+				if cols[3] not in junction_list:
+					continue
+			elif not ((cols[0] == chrom or cols[0] == f"chr{chrom}") and start < int(cols[1]) < end and start < int(cols[2]) < end):
+				continue
+			for sample, value in zip(samples, cols[4:]):
+				junctions_dict.setdefault(sample, {})[cols[3]] = int(value)
+	return junctions_dict
+
+def get_psi_values(psi_matrix_path, positional_id) -> dict:
+	"""
+	PSI values (%) of the event by scanning the PSI matrix.
+	"""
+	samples = []
+	with open(psi_matrix_path) as psi_matrix:
+		for line in psi_matrix:
+			cols = line.rstrip("\n").split("\t")
+			if line.startswith("event_id"):
+				samples = cols[2:]
+				continue
+			if cols[1] == positional_id:
+				return {sample: float(psi) * 100 if psi.replace(".", "", 1).isdigit() else "NA" for sample, psi in zip(samples, cols[2:])}
+	return {sample: "NA" for sample in samples}
+
+def get_event(event_file_path, positional_id) -> dict:
+	"""
+	Columns of the event by scanning the EVENT file.
+	"""
+	with open(event_file_path) as event_file:
+		header = event_file.readline().rstrip("\n").split("\t")
+		for line in event_file:
+			cols = line.rstrip("\n").split("\t")
+			if cols[1] == positional_id:
+				return dict(zip(header, cols))
+	return {}
+
+def aggregate_coverage(coverages, method, band) -> np.ndarray:
+	"""
+	Coverage of a group with band, from all samples stacked in float64.
+	"""
+	stacked = np.vstack([np.asarray(coverage, dtype = np.float64) for coverage in coverages])
+	center = np.median(stacked, axis = 0) if method == "median" else stacked.mean(axis = 0)
+	if band == "minmax":
+		return np.vstack([center, stacked.min(axis = 0), stacked.max(axis = 0)])
+	if band == "iqr":
+		return np.vstack([center] + list(np.percentile(stacked, [25, 75], axis = 0)))
+	return center
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Time each stage of shiba2sashimi and the end-to-end run on a synthetic fixture,
+and check the results against the reference implementations in reference.py.
+
+Usage:
+	python benchmarks/run_benchmarks.py [--fixture DIR] [--events N] [--repeat N] [--json FILE]
+
+Without --fixture, a fixture is generated in a temporary directory (see generate_fixture.py).
+The shiba2sashimi package in src/ of this repository is benchmarked.
+Exit status is 1 if any result differs from the reference, or if start-up of the command line tool
+imports matplotlib or pysam or takes longer than --max_cold_start seconds.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "src")
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import generate_fixture
+import reference
+from shiba2sashimi import bams, junc, tables, utils, session, aggregate
+from shiba2sashimi.main import parse_args
+
+def get_args(argv = None):
+	parser = argparse.ArgumentParser(description = "Benchmark shiba2sashimi on a synthetic fixture")
+	parser.add_argument("--fixture", help = "Fixture directory created by generate_fixture.py. Generated in a temporary directory if not given")
+	parser.add_argument("--events", type = int, default = 20, help = "Number of events to benchmark. Default: %(default)s")
+	parser.add_argument("--repeat", type = int, default = 3, help = "Number of repeats of each stage (the best time is reported). Default: %(default)s")
+	parser.add_argument("--json", help = "Write results to this file in JSON")
+	parser.add_argument("--no_reference", action = "store_true", help = "Skip checks against the reference implementations")
+	parser.add_argument("--no_end_to_end", action = "store_true", help = "Skip end-to-end runs of the command line tool")
+	parser.add_argument("--max_cold_start", type = float, default = 1.0, help = "Maximum seconds of 'shiba2sashimi --help' in a new process. Default: %(default)s")
+	return parser.parse_args(argv)
+
+# Modules that the command line tool should import only when they are needed
+HEAVY_MODULES = ["matplotlib", "pysam"]
+
+def command_env() -> dict:
+	"""
+	Return environment to run the shiba2sashimi package in src/ in a new process.
+	"""
+	return dict(os.environ, PYTHONPATH = SRC_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+
+def best_time(func, repeat) -> tuple:
+	"""
+	Run func repeat times and return the best elapsed time and the last result.
+	"""
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = func()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+class Benchmark:
+
+	def __init__(self, fixture, pos_ids, repeat, check):
+		self.fixture = fixture
+		self.shiba = os.path.join(fixture, "shiba")
+		self.pos_ids = pos_ids
+		self.repeat = repeat
+		self.check = check
+		self.experiment_dict = tables.load_experiment_table(os.path.join(fixture, "experiment.tsv"))
+		self.samples = list(self.experiment_dict)
+		self.args = parse_args(["-e", os.path.join(fixture, "experiment.tsv"), "-s", self.shiba, "-o", ""])
+		self.events = [session.resolve_event(self.args, pos_id) for pos_id in pos_ids]
+		self.results = []
+
+	def record(self, stage, calls, elapsed, mismatches = None):
+		status = "skipped" if mismatches is None else ("ok" if not mismatches else "MISMATCH")
+		self.results.append({
+			"stage": stage,
+			"calls": calls,
+			"seconds": elapsed,
+			"seconds_per_call": elapsed / calls if calls else None,
+			"check": status,
+			"mismatches": mismatches[:10] if mismatches else []
+		})
+
+	def median_filter(self):
+		rng = np.random.default_rng(0)
+		data = rng.poisson(30, 200000)
+		elapsed, filtered = best_time(lambda: bams.median_filter(data, 21), self.repeat)
+		mismatches = None
+		if self.check:
+			# The reference is slow, so check the first 20 kb only
+			mismatches = [] if np.array_equal(bams.median_filter(data[:20000], 21), reference.median_filter(data[:20000], 21)) else ["first 20 kb"]
+		self.record("bams.median_filter (200 kb)", 1, elapsed, mismatches)
+
+	def aggregate_coverage(self):
+		rng = np.random.default_rng(0)
+		# Samples in uint16 and uint32 (depth above 65535), in both orders
+		coverages = [rng.integers(0, 60000, 200000).astype(np.uint16), rng.integers(0, 200000, 200000).astype(np.uint32), rng.integers(0, 60000, 200000).astype(np.uint16)]
+		def run():
+			results = []
+			for order in [coverages, coverages[::-1]]:
+				for method, band in [("mean", "minmax"), ("median", "iqr")]:
+					accumulator = aggregate.CoverageAccumulator(method, band)
+					for coverage in order:
+						accumulator.add(coverage)
+					results.append(((method, band), accumulator.result()))
+			return results
+		elapsed, results = best_time(run, self.repeat)
+		mismatches = None
+		if self.check:
+			mismatches = []
+			for (method, band), result in results:
+				expected = reference.aggregate_coverage(coverages, method, band)
+				if not np.allclose(result, expected):
+					mismatches.append(f"{method} {band}")
+		self.record("aggregate.CoverageAccumulator (uint16 + uint32)", len(results), elapsed, mismatches)
+
+	def get_coverage(self, engine):
+		def run():
+			return [[bams.get_coverage(self.experiment_dict[sample]["bam"], event["chrom"], event["start"], event["end"], window_size = 1, engine = engine)
+				for sample in self.samples] for event in self.events]
+		elapsed, coverages = best_time(run, self.repeat)
+		mismatches = None
+		if self.check:
+			mismatches = []
+			for event, event_coverages in zip(self.events, coverages):
+				for sample, coverage in zip(self.samples, event_coverages):
+					expected = reference.depth(self.experiment_dict[sample]["bam"], event["chrom"], event["start"], event["end"])
+					if not np.array_equal(coverage, expected):
+						mismatches.append(f"{event['pos_id']} {sample}")
+		self.record(f"bams.get_coverage (engine={engine})", len(self.events) * len(self.samples), elapsed, mismatches)
+
+	def extract_junctions(self, use_index):
+		def run():
+			return [junc.extract_junctions_in_region(self.shiba, event["chrom"], event["start"], event["end"], junction_list, use_index)
+				for event in self.events for junction_list in [None, event["junction_list"]]]
+		elapsed, junctions_dicts = best_time(run, self.repeat)
+		mismatches = None
+		if self.check:
+			junctions_bed = os.path.join(self.shiba, "junctions", "junctions.bed")
+			queries = [(event, junction_list) for event in self.events for junction_list in [None, event["junction_list"]]]
+			mismatches = [
+				f"{event['pos_id']} {'by ID' if junction_list else 'by region'}"
+				for (event, junction_list), junctions_dict in zip(queries, junctions_dicts)
+				if junctions_dict.to_dict() != reference.extract_junctions_in_region(junctions_bed, event["chrom"], event["start"], event["end"], junction_list)
+			]
+		self.record(f"junc.extract_junctions_in_region (use_index={use_index})", 2 * len(self.events), elapsed, mismatches)
+
+	def get_psi_values(self, use_index):
+		elapsed, psi_values = best_time(lambda: [tables.get_psi_values(pos_id, self.shiba, use_index) for pos_id in self.pos_ids], self.repeat)
+		mismatches = None
+		if self.check:
+			psi_matrix_path = os.path.join(self.shiba, "results", "splicing", "PSI_matrix_sample.txt")
+			mismatches = [pos_id for pos_id, values in zip(self.pos_ids, psi_values) if values != reference.get_psi_values(psi_matrix_path, pos_id)]
+		self.record(f"tables.get_psi_values (use_index={use_index})", len(self.pos_ids), elapsed, mismatches)
+
+	def posid2int(self, use_index):
+		elapsed, regions = best_time(lambda: [utils.posid2int(pos_id, self.shiba, 500, 500, use_index = use_index) for pos_id in self.pos_ids], self.repeat)
+		mismatches = None
+		if self.check:
+			event_file_path = os.path.join(self.shiba, "events", "EVENT_SE.txt")
+			mismatches = [
+				pos_id for pos_id, region in zip(self.pos_ids, regions)
+				if region != utils.posid2int(pos_id, self.shiba, 500, 500, event_file_col_dict = reference.get_event(event_file_path, pos_id))
+			]
+		self.record(f"utils.posid2int (use_index={use_index})", len(self.pos_ids), elapsed, mismatches)
+
+	def sashimi(self, output_dir):
+		data = [session.get_event_data(self.args, event, self.experiment_dict, self.samples) for event in self.events[:5]]
+		def run():
+			for n, (event, (coverage_dict, junctions_dict)) in enumerate(zip(self.events, data)):
+				session.plot_event(self.args, event, self.experiment_dict, coverage_dict, junctions_dict, os.path.join(output_dir, f"{n}.png"))
+		elapsed, _ = best_time(run, self.repeat)
+		self.record("plots.sashimi (png)", len(data), elapsed)
+
+	def cold_start(self, max_seconds):
+		env = command_env()
+		code = f"import sys, shiba2sashimi.main; print(' '.join(module for module in {HEAVY_MODULES!r} if module in sys.modules))"
+		elapsed, result = best_time(lambda: subprocess.run([sys.executable, "-c", code], env = env, capture_output = True, text = True), self.repeat)
+		mismatches = [f"exit status {result.returncode}"] if result.returncode else [f"{module} imported" for module in result.stdout.split()]
+		self.record("cold start: import shiba2sashimi.main", 1, elapsed, mismatches)
+		elapsed, returncode = best_time(lambda: subprocess.run([sys.executable, "-m", "shiba2sashimi.main", "--help"], env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode, self.repeat)
+		mismatches = [f"exit status {returncode}"] if returncode else ([f"{elapsed:.2f} s > {max_seconds} s"] if elapsed > max_seconds else [])
+		self.record("cold start: --help", 1, elapsed, mismatches)
+
+	def end_to_end(self, output_dir):
+		env = command_env()
+		command = [sys.executable, "-m", "shiba2sashimi.main", "-e", os.path.join(self.fixture, "experiment.tsv"), "-s", self.shiba]
+		batch_file = os.path.join(output_dir, "events.txt")
+		with open(batch_file, "w") as f:
+			f.write("".join(f"{pos_id}\n" for pos_id in self.pos_ids))
+		for stage, options, calls in [
+			("end-to-end: single event", ["--id", self.pos_ids[0], "-o", os.path.join(output_dir, "single.png")], 1),
+			("end-to-end: --batch", ["--batch", batch_file, "-o", os.path.join(output_dir, "batch")], len(self.pos_ids))
+		]:
+			elapsed, returncode = best_time(lambda: subprocess.run(command + options, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode, self.repeat)
+			self.record(stage, calls, elapsed, [f"exit status {returncode}"] if returncode else [])
+
+def print_results(results):
+	width = max(len(result["stage"]) for result in results)
+	print(f"{'stage':<{width}}  {'calls':>6}  {'total (s)':>10}  {'per call (ms)':>13}  check")
+	for result in results:
+		per_call = f"{result['seconds_per_call'] * 1000:.2f}" if result["seconds_per_call"] is not None else "-"
+		print(f"{result['stage']:<{width}}  {result['calls']:>6}  {result['seconds']:>10.4f}  {per_call:>13}  {result['check']}")
+		for mismatch in result["mismatches"]:
+			print(f"    {mismatch}")
+
+def main(argv = None):
+	args = get_args(argv)
+	tmp_dir = tempfile.mkdtemp(prefix = "shiba2sashimi_benchmark_")
+	try:
+		fixture = args.fixture
+		if fixture is None:
+			fixture = os.path.join(tmp_dir, "fixture")
+			generate_fixture.generate(generate_fixture.get_args([fixture]))
+		with open(os.path.join(fixture, "events.txt")) as f:
+			pos_ids = [line.strip() for line in f if line.strip()][:args.events]
+		benchmark = Benchmark(fixture, pos_ids, args.repeat, not args.no_reference)
+		benchmark.median_filter()
+		benchmark.aggregate_coverage()
+		for engine in bams.COVERAGE_ENGINES:
+			benchmark.get_coverage(engine)
+		for use_index in [True, False]:
+			benchmark.extract_junctions(use_index)
+			benchmark.get_psi_values(use_index)
+			benchmark.posid2int(use_index)
+		benchmark.sashimi(tmp_dir)
+		benchmark.cold_start(args.max_cold_start)
+		if not args.no_end_to_end:
+			benchmark.end_to_end(tmp_dir)
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors = True)
+	print_results(benchmark.results)
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump(benchmark.results, f, indent = 2)
+	return 1 if any(result["check"] == "MISMATCH" for result in benchmark.results) else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,118 @@
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+import numpy as np
+
+# Statistics of coverage of each group
+AGGREGATE_METHODS = ["mean", "median"]
+# Band around the group coverage
+BAND_METHODS = ["none", "minmax", "iqr"]
+# Statistics of junction read numbers of each group
+JUNCTION_AGGREGATE_METHODS = ["sum", "mean"]
+
+class CoverageAccumulator:
+	"""
+	Accumulate coverage arrays of the samples in a group, one sample at a time.
+
+	Mean and min/max band are updated in place in float64, so memory does not grow with the number of samples
+	and samples in different integer types (uint16 or uint32, see bams.compact_depth) can be mixed.
+	Median and IQR band need coverage of all samples in the group, which is kept in the smallest integer type.
+	"""
+
+	def __init__(self, method = "mean", band = "none"):
+		if method not in AGGREGATE_METHODS:
+			raise ValueError(f"Unknown aggregate method: {method}")
+		if band not in BAND_METHODS:
+			raise ValueError(f"Unknown band: {band}")
+		self.method = method
+		self.band = band
+		self.n_samples = 0
+		self.total = None
+		self.lower = None
+		self.upper = None
+		self.stacked = []
+
+	def add(self, coverage):
+		coverage = np.asarray(coverage)
+		self.n_samples += 1
+		if self.method == "median" or self.band == "iqr":
+			if np.issubdtype(coverage.dtype, np.integer) and coverage.size:
+				coverage = coverage.astype(np.min_scalar_type(max(int(coverage.max()), 0)))
+			self.stacked.append(coverage)
+			return
+		if self.total is None:
+			self.total = coverage.astype(np.float64)
+		else:
+			self.total += coverage
+		if self.band == "minmax":
+			if self.lower is None:
+				self.lower = coverage.astype(np.float64)
+				self.upper = coverage.astype(np.float64)
+			else:
+				np.minimum(self.lower, coverage, out = self.lower)
+				np.maximum(self.upper, coverage, out = self.upper)
+
+	def result(self) -> np.ndarray:
+		"""
+		Return coverage of the group, or array of (coverage, lower, upper) stacked in rows if band is given.
+		"""
+		if self.n_samples == 0:
+			raise ValueError("No coverage added to the group")
+		if self.stacked:
+			stacked = np.vstack(self.stacked)
+			center = np.median(stacked, axis = 0) if self.method == "median" else stacked.mean(axis = 0)
+			if self.band == "iqr":
+				lower, upper = np.percentile(stacked, [25, 75], axis = 0)
+			elif self.band == "minmax":
+				lower, upper = stacked.min(axis = 0), stacked.max(axis = 0)
+		else:
+			center = self.total / self.n_samples
+			lower, upper = self.lower, self.upper
+		if self.band == "none":
+			return center
+		return np.vstack([center, lower, upper])
+
+def group_samples(experiment_dict, samples, groups = None) -> dict:
+	"""
+	Return samples of each group, in the order of groups if given, otherwise in the order of the experiment table.
+
+	Returns
+	- sample_groups: dict
+		{group: [sample]}
+	"""
+	sample_groups = {group: [] for group in groups.split(",")} if groups else {}
+	for sample in experiment_dict:
+		if sample in samples:
+			sample_groups.setdefault(experiment_dict[sample]["group"], []).append(sample)
+	return {group: members for group, members in sample_groups.items() if members}
+
+def aggregate_junctions(junction_table, sample_groups, method = "sum"):
+	"""
+	Sum or average read numbers of each junction over the samples of each group.
+
+	Returns
+	- group_junction_table: junc.JunctionTable
+		Read numbers of junctions (int, or float rounded to 1 decimal with mean) in each group
+	"""
+	if method not in JUNCTION_AGGREGATE_METHODS:
+		raise ValueError(f"Unknown junction aggregate method: {method}")
+	counts = np.zeros((len(junction_table), len(sample_groups)), dtype = junction_table.counts.dtype if method == "sum" else np.float64)
+	for j, samples in enumerate(sample_groups.values()):
+		cols = [junction_table.sample_index[sample] for sample in samples if sample in junction_table.sample_index]
+		total = junction_table.counts[:, cols].sum(axis = 1)
+		counts[:, j] = total if method == "sum" else np.round(total / len(samples), 1)
+	return type(junction_table)(junction_table.ids, sample_groups.keys(), counts, junction_table.starts, junction_table.ends)
+
+def aggregate_psi_values(psi_values_dict, sample_groups) -> dict:
+	"""
+	Average PSI values over the samples of each group, ignoring NA. The group is NA if all samples are NA.
+
+	Returns
+	- group_psi_values_dict: dict
+		{group: psi}
+	"""
+	group_psi_values_dict = {}
+	for group, samples in sample_groups.items():
+		values = [psi_values_dict[sample] for sample in samples if isinstance(psi_values_dict.get(sample), float)]
+		group_psi_values_dict[group] = sum(values) / len(values) if values else "NA"
+	return group_psi_values_dict
@@ -0,0 +1,123 @@
+import os
+import re
+import gzip
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+import numpy as np
+from . import utils
+
+# Suffix of sidecar index file of GTF
+GTF_INDEX_SUFFIX = ".s2s_index.npz"
+
+def parse_attribute(attributes, key):
+	match = re.search(f'{key} "([^"]*)"', attributes)
+	return match.group(1) if match else None
+
+def build_gtf_index(gtf_path) -> dict:
+	"""
+	Build index of transcripts and their exons in GTF (optionally gzipped), sorted by chromosome and start.
+
+	Returns
+	- index: dict
+		chroms, chrom_max_lengths: chromosome names and maximum transcript length of each chromosome
+		tx_chroms, tx_starts, tx_ends: chromosome index, start and end (0-based, half-open) of each transcript
+		tx_ids, tx_names, tx_strands: transcript ID, gene name (or gene ID) and strand of each transcript
+		tx_exon_offsets: exons of transcript i are exon_starts/exon_ends[tx_exon_offsets[i]:tx_exon_offsets[i + 1]]
+	"""
+	logger.info(f"Building index of {gtf_path}")
+	signature = utils.file_signature(gtf_path)
+	transcripts = {}
+	opener = gzip.open if gtf_path.endswith(".gz") else open
+	with opener(gtf_path, "rt") as gtf:
+		for line in gtf:
+			if line.startswith("#"):
+				continue
+			cols = line.rstrip("\n").split("\t")
+			if len(cols) < 9 or cols[2] != "exon":
+				continue
+			transcript_id = parse_attribute(cols[8], "transcript_id")
+			if transcript_id is None:
+				continue
+			if transcript_id not in transcripts:
+				name = parse_attribute(cols[8], "gene_name") or parse_attribute(cols[8], "gene_id") or transcript_id
+				transcripts[transcript_id] = [cols[0], name, cols[6], []]
+			transcripts[transcript_id][3].append((int(cols[3]) - 1, int(cols[4])))
+	chrom_index = {}
+	rows = []
+	for transcript_id, (chrom, name, strand, exons) in transcripts.items():
+		exons.sort()
+		rows.append((chrom_index.setdefault(chrom, len(chrom_index)), exons[0][0], exons[-1][1], transcript_id, name, strand, exons))
+	rows.sort(key = lambda row: (row[0], row[1], row[2]))
+	tx_chroms = np.array([row[0] for row in rows], dtype=np.int32)
+	tx_starts = np.array([row[1] for row in rows], dtype=np.int64)
+	tx_ends = np.array([row[2] for row in rows], dtype=np.int64)
+	chrom_max_lengths = np.zeros(len(chrom_index), dtype=np.int64)
+	np.maximum.at(chrom_max_lengths, tx_chroms, tx_ends - tx_starts)
+	index = {
+		"chroms": np.array(list(chrom_index), dtype=str),
+		"chrom_max_lengths": chrom_max_lengths,
+		"tx_chroms": tx_chroms,
+		"tx_starts": tx_starts,
+		"tx_ends": tx_ends,
+		"tx_ids": np.array([row[3] for row in rows], dtype=str),
+		"tx_names": np.array([row[4] for row in rows], dtype=str),
+		"tx_strands": np.array([row[5] for row in rows], dtype=str),
+		"tx_exon_offsets": np.cumsum([0] + [len(row[6]) for row in rows]).astype(np.int64),
+		"exon_starts": np.array([exon[0] for row in rows for exon in row[6]], dtype=np.int64),
+		"exon_ends": np.array([exon[1] for row in rows for exon in row[6]], dtype=np.int64)
+	}
+	utils.save_sidecar_index(gtf_path, GTF_INDEX_SUFFIX, signature, index)
+	logger.info(f"{len(rows)} transcripts indexed")
+	return index
+
+def load_gtf_index(gtf_path) -> dict:
+	"""
+	Load index of GTF, building it if it does not exist or the file has changed.
+	Indexes are kept in memory for later calls in the same process.
+	"""
+	if not os.path.exists(gtf_path):
+		logger.error(f"GTF file not found: {gtf_path}")
+		logger.error("Please double check and provide a valid GTF file")
+		raise FileNotFoundError(f"GTF file not found: {gtf_path}")
+	return utils.load_cached_index(gtf_path, GTF_INDEX_SUFFIX, lambda: build_gtf_index(gtf_path))
+
+def query_transcripts(index, chrom, start, end, max_transcripts = None) -> list:
+	"""
+	Return transcripts overlapping the region using index, sorted by start.
+
+	Returns
+	- transcripts: list
+		List of {transcript_id, name, strand, start, end, exons: [(start, end)]} (0-based, half-open)
+	"""
+	transcripts = []
+	for tx_chrom in set([chrom, f"chr{chrom}", chrom.replace("chr", "")]):
+		chrom_idx = np.flatnonzero(index["chroms"] == tx_chrom)
+		if len(chrom_idx) == 0:
+			continue
+		lo = np.searchsorted(index["tx_chroms"], chrom_idx[0], side="left")
+		hi = np.searchsorted(index["tx_chroms"], chrom_idx[0], side="right")
+		# Transcripts starting before the region end and not longer than the longest transcript of the chromosome
+		chrom_starts = index["tx_starts"][lo:hi]
+		lo, hi = lo + np.searchsorted(chrom_starts, start - index["chrom_max_lengths"][chrom_idx[0]], side="left"), lo + np.searchsorted(chrom_starts, end, side="left")
+		for i in (lo + np.flatnonzero(index["tx_ends"][lo:hi] > start)).tolist():
+			exon_lo, exon_hi = index["tx_exon_offsets"][i], index["tx_exon_offsets"][i + 1]
+			transcripts.append({
+				"transcript_id": str(index["tx_ids"][i]),
+				"name": str(index["tx_names"][i]),
+				"strand": str(index["tx_strands"][i]),
+				"start": int(index["tx_starts"][i]),
+				"end": int(index["tx_ends"][i]),
+				"exons": list(zip(index["exon_starts"][exon_lo:exon_hi].tolist(), index["exon_ends"][exon_lo:exon_hi].tolist()))
+			})
+	transcripts.sort(key = lambda transcript: (transcript["start"], transcript["end"]))
+	if max_transcripts is not None and len(transcripts) > max_transcripts:
+		logger.debug(f"{len(transcripts)} transcripts in the region; showing the first {max_transcripts}")
+		transcripts = transcripts[:max_transcripts]
+	return transcripts
+
+def get_transcripts(gtf_path, chrom, start, end, max_transcripts = None) -> list:
+	"""
+	Return transcripts in GTF overlapping the region (see query_transcripts).
+	"""
+	return query_transcripts(load_gtf_index(gtf_path), chrom, start, end, max_transcripts)
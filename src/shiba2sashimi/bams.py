@@ -1,62 +1,475 @@
-import sys
 import os
 import logging
+import contextlib
+import collections.abc
+import concurrent.futures
 # Configure logging
 logger = logging.getLogger(__name__)
-import pysam
 import numpy as np
+from . import profiling
+
+# Maximum number of elements of sliding windows processed at once by median_filter
+MEDIAN_CHUNK_ELEMENTS = 1 << 22
+# Number of positions processed at once by mean_filter
+MEAN_CHUNK_SIZE = 1 << 18
 
 def median_filter(data, window_size):
 	"""
 	Apply a median filter to the data with the specified window size.
+	Windows are truncated at both ends of the data.
 	"""
+	data = np.asarray(data)
 	filtered_data = np.zeros_like(data)
+	data_len = len(data)
 	half_window = window_size // 2
-	for i in range(len(data)):
+	full_window = 2 * half_window + 1
+	# Truncated windows at both ends
+	n_head = min(half_window, data_len)
+	n_tail_start = max(n_head, data_len - half_window)
+	for i in list(range(n_head)) + list(range(n_tail_start, data_len)):
 		start = max(0, i - half_window)
-		end = min(len(data), i + half_window + 1)
+		end = min(data_len, i + half_window + 1)
 		filtered_data[i] = np.median(data[start:end])
+	# Full windows: take median of a strided view of the data, chunk by chunk to bound memory
+	n_full = data_len - 2 * half_window
+	if n_full > 0:
+		windows = np.lib.stride_tricks.as_strided(
+			data, shape = (n_full, full_window), strides = (data.strides[0], data.strides[0]), writeable = False
+		)
+		chunk_size = max(1, MEDIAN_CHUNK_ELEMENTS // full_window)
+		for chunk_start in range(0, n_full, chunk_size):
+			chunk = windows[chunk_start:chunk_start + chunk_size]
+			# Window size is always odd here, so the median is the middle element
+			filtered_data[chunk_start + half_window:chunk_start + half_window + len(chunk)] = np.partition(chunk, half_window, axis = 1)[:, half_window]
 	return filtered_data
 
-def get_coverage(bam_path, chrom, start, end, window_size=21):
+def mean_filter(data, window_size):
 	"""
-	Return coverage array of the specified region (chrom, start, end) using pysam.
+	Apply a moving average filter to the data with the specified window size in O(n) using cumulative sum.
+	Windows are truncated at both ends of the data in the same way as median_filter.
+	"""
+	data = np.asarray(data)
+	data_len = len(data)
+	half_window = window_size // 2
+	cumsum = np.concatenate(([0.0], np.cumsum(data, dtype = float)))
+	# Averages are returned in float32 to halve memory of the smoothed coverage,
+	# and calculated chunk by chunk to bound memory of the window bounds
+	filtered_data = np.empty(data_len, dtype = np.float32)
+	for chunk_start in range(0, data_len, MEAN_CHUNK_SIZE):
+		positions = np.arange(chunk_start, min(chunk_start + MEAN_CHUNK_SIZE, data_len))
+		start = np.maximum(0, positions - half_window)
+		end = np.minimum(data_len, positions + half_window + 1)
+		filtered_data[positions[0]:positions[-1] + 1] = (cumsum[end] - cumsum[start]) / (end - start)
+	return filtered_data
+
+# Smoothing methods selectable from command line
+SMOOTHING_METHODS = {
+	"median": median_filter,
+	"mean": mean_filter
+}
+
+def smooth(data, window_size, method = "median"):
+	"""
+	Smooth coverage with the specified method (see SMOOTHING_METHODS).
+	"""
+	if method not in SMOOTHING_METHODS:
+		logger.error(f"Unsupported smoothing method: {method}")
+		logger.error(f"Please choose from {', '.join(SMOOTHING_METHODS)}")
+		raise ValueError(f"Unsupported smoothing method: {method}")
+	return SMOOTHING_METHODS[method](data, window_size)
+
+def is_cram(bam_path) -> bool:
+	return bam_path.lower().endswith(".cram")
+
+def index_paths(bam_path) -> list:
+	"""
+	Return possible index files of the BAM (.bai or .csi) or CRAM (.crai) file.
+	"""
+	suffixes = [".crai"] if is_cram(bam_path) else [".bai", ".csi"]
+	return [f"{bam_path}{suffix}" for suffix in suffixes] + [f"{os.path.splitext(bam_path)[0]}{suffix}" for suffix in suffixes]
+
+def check_bam(bam_path, reference = None):
+	"""
+	Check if the BAM/CRAM file and its index (and reference FASTA if given) exist.
 	"""
-	# Check if the BAM file and its index exist
 	if not os.path.exists(bam_path):
 		logger.error(f"BAM file not found: {bam_path}")
 		logger.error("Please double check and provide a valid BAM file")
 		raise FileNotFoundError(f"BAM file not found: {bam_path}")
-		sys.exit(1)
-	if not (os.path.exists(f"{bam_path}.bai") or os.path.exists(f"{bam_path}.csi")):
-		logger.error(f"BAM index not found: {bam_path}.bai or {bam_path}.csi")
+	if not any(os.path.exists(path) for path in index_paths(bam_path)):
+		file_type = "CRAM" if is_cram(bam_path) else "BAM"
+		index_names = f"{bam_path}.crai" if is_cram(bam_path) else f"{bam_path}.bai or {bam_path}.csi"
+		logger.error(f"{file_type} index not found: {index_names}")
 		logger.error("Please create index using samtools index")
-		raise FileNotFoundError(f"BAM index not found: {bam_path}.bai or {bam_path}.csi")
-		sys.exit(1)
-	# Initialize coverage array
+		raise FileNotFoundError(f"{file_type} index not found: {index_names}")
+	if reference is not None and not os.path.exists(reference):
+		logger.error(f"Reference FASTA not found: {reference}")
+		logger.error("Please provide the reference FASTA used to create the CRAM files")
+		raise FileNotFoundError(f"Reference FASTA not found: {reference}")
+
+def open_bam(bam_path, reference = None, threads = 1):
+	"""
+	Open BAM or CRAM file after checking that the file and its index exist.
+
+	Parameters
+	- reference: str
+		Reference FASTA to decode CRAM files (optional). Without it, htslib looks up
+		the reference by the UR/M5 tags of the header (REF_PATH, REF_CACHE).
+	- threads: int
+		Number of htslib threads to decompress the file
+	"""
+	# Imported here to keep start-up of commands that do not read BAM files fast
+	import pysam
+	check_bam(bam_path, reference if is_cram(bam_path) else None)
+	if is_cram(bam_path):
+		return pysam.AlignmentFile(bam_path, "rc", reference_filename = reference, threads = max(threads, 1))
+	return pysam.AlignmentFile(bam_path, "rb", threads = max(threads, 1))
+
+def contig_aliases(bam) -> dict:
+	"""
+	Return map from contig names (with or without "chr" prefix) to reference names in the BAM file.
+	"""
+	aliases = {}
+	for reference in bam.references:
+		aliases[reference] = reference
+		if not reference.startswith("chr"):
+			aliases.setdefault(f"chr{reference}", reference)
+	return aliases
+
+def reference_name(bam, chrom) -> str:
+	"""
+	Return name of chrom in the BAM file, removing "chr" prefix if only the name without it is found.
+	"""
+	if chrom in bam.references:
+		return chrom
+	logger.debug(f"Chromosome {chrom} not found in BAM file")
+	if chrom.replace("chr", "") in bam.references:
+		logger.debug("Using the name without 'chr' prefix")
+		return chrom.replace("chr", "")
+	return chrom
+
+def keep_read(read, min_mapq=0, keep_duplicates=False, keep_secondary=False):
+	"""
+	Return True if the read should be counted for coverage.
+	Unmapped and QC-failed reads are always skipped.
+	"""
+	if read.is_unmapped or read.is_qcfail:
+		return False
+	if read.mapping_quality < min_mapq:
+		return False
+	if read.is_duplicate and not keep_duplicates:
+		return False
+	if read.is_secondary and not keep_secondary:
+		return False
+	return True
+
+def count_read_junctions(read, junctions):
+	"""
+	Add introns (N operations in CIGAR) of the read to junctions {(start, end): reads} (0-based, half-open).
+	"""
+	pos = read.reference_start
+	for op, length in read.cigartuples:
+		if op == 3:
+			junction = (pos, pos + length)
+			junctions[junction] = junctions.get(junction, 0) + 1
+			pos += length
+		elif op in (0, 2, 7, 8):
+			pos += length
+
+def pileup_depth(bam, chrom, start, end, min_mapq=0, keep_duplicates=False, keep_secondary=False, junctions=None):
+	"""
+	Return depth of the region by summing up per-base counts of AlignmentFile.count_coverage.
+	Bases with base quality below 15 are not counted.
+	If a dict is given as junctions, introns of the counted reads are added to it in the same pass.
+	"""
+	if junctions is not None:
+		def read_callback(read):
+			if not keep_read(read, min_mapq, keep_duplicates, keep_secondary):
+				return False
+			count_read_junctions(read, junctions)
+			return True
+	elif min_mapq == 0 and not keep_duplicates and not keep_secondary:
+		read_callback = "all"
+	else:
+		read_callback = lambda read: keep_read(read, min_mapq, keep_duplicates, keep_secondary)
+	count = bam.count_coverage(chrom, start, end, read_callback = read_callback)
+	# Sum up coverage for each base in place, without copying counts of each base
+	# (counts stop at the end of the contig, and bases after it are left as 0 as with the blocks engine)
+	depth = np.zeros(end - start, dtype = np.uint32)
+	for base_count in count:
+		base_count = np.asarray(base_count)
+		depth[:len(base_count)] += base_count
+	return depth
+
+def block_depth(bam, chrom, start, end, min_mapq=0, keep_duplicates=False, keep_secondary=False, junctions=None):
+	"""
+	Return depth of the region from aligned blocks of each read using a difference array.
+	Introns (N) and deletions (D) are not counted, and base quality is ignored.
+	If a dict is given as junctions, introns of the counted reads are added to it in the same pass.
+	"""
 	arr_len = end - start
-	coverage = np.zeros(arr_len, dtype=int)
-	# Open BAM file with pysam.AlignmentFile
-	with pysam.AlignmentFile(bam_path, "rb") as bam:
-		# Get coverage using pileup
-		try:
-			count = bam.count_coverage(chrom, start, end)
-		except KeyError:
-			logger.debug(f"Chromosome {chrom} not found in BAM file")
-			# Remove "chr" prefix and try again
-			logger.debug(f"Trying without 'chr' prefix")
-			chrom = chrom.replace("chr", "")
-			count = bam.count_coverage(chrom, start, end)
-		except Exception as e:
-			logger.error(f"Failed to get coverage for {chrom}:{start}-{end}")
-			logger.error(f"Error: {e}")
-			sys.exit(1)
-		for i in range(arr_len):
-			total = 0
-			# Sum up coverage for each base
-			for j in range(4):
-				total += count[j][i]
-			coverage[i] = total
-	# Apply median filter for smooth coverage plot
-	coverage = median_filter(coverage, window_size)
+	block_starts = []
+	block_ends = []
+	for read in bam.fetch(chrom, start, end):
+		if not keep_read(read, min_mapq, keep_duplicates, keep_secondary):
+			continue
+		if junctions is not None:
+			count_read_junctions(read, junctions)
+		for block_start, block_end in read.get_blocks():
+			block_starts.append(block_start)
+			block_ends.append(block_end)
+	# +1 at the start and -1 at the end of each block, clipped to the region
+	block_starts = np.clip(np.asarray(block_starts, dtype = int) - start, 0, arr_len)
+	block_ends = np.clip(np.asarray(block_ends, dtype = int) - start, 0, arr_len)
+	diff = np.bincount(block_starts, minlength = arr_len + 1) - np.bincount(block_ends, minlength = arr_len + 1)
+	return np.cumsum(diff[:arr_len])
+
+# Engines to calculate depth selectable from command line
+COVERAGE_ENGINES = {
+	"pileup": pileup_depth,
+	"blocks": block_depth
+}
+
+def get_depth(bam, chrom, start, end, engine="pileup", min_mapq=0, keep_duplicates=False, keep_secondary=False, junctions=None):
+	"""
+	Return raw (unsmoothed) depth of the specified region with the specified engine (see COVERAGE_ENGINES).
+	If a dict is given as junctions, introns of the reads are counted in it (see count_read_junctions).
+	"""
+	if engine not in COVERAGE_ENGINES:
+		logger.error(f"Unsupported coverage engine: {engine}")
+		logger.error(f"Please choose from {', '.join(COVERAGE_ENGINES)}")
+		raise ValueError(f"Unsupported coverage engine: {engine}")
+	depth_func = COVERAGE_ENGINES[engine]
+	return depth_func(bam, reference_name(bam, chrom), start, end, min_mapq, keep_duplicates, keep_secondary, junctions)
+
+def count_junctions(bam, chrom, start, end, min_mapq=0, keep_duplicates=False, keep_secondary=False) -> dict:
+	"""
+	Return introns {(start, end): reads} (0-based, half-open) of the reads in the region without calculating depth.
+	Reads are selected in the same way as get_depth.
+	"""
+	junctions = {}
+	for read in bam.fetch(reference_name(bam, chrom), start, end):
+		if keep_read(read, min_mapq, keep_duplicates, keep_secondary):
+			count_read_junctions(read, junctions)
+	return junctions
+
+def compact_depth(depth) -> np.ndarray:
+	"""
+	Return depth in uint16, or uint32 if it does not fit.
+	"""
+	depth = np.asarray(depth)
+	dtype = np.uint16 if depth.size == 0 or depth.max() <= np.iinfo(np.uint16).max else np.uint32
+	return depth.astype(dtype, copy = False)
+
+def get_coverage(bam_path, chrom, start, end, window_size=21, bam=None, smoothing="median", cache=None, junctions=None, open_options=None, **depth_options):
+	"""
+	Return coverage array of the specified region (chrom, start, end) using pysam.
+	If an opened AlignmentFile is given as bam, it is used instead of opening bam_path again.
+	If a CoverageCache is given as cache, raw coverage is read from and stored in the cache.
+	If a dict is given as junctions, introns of the reads are counted in it while calculating coverage.
+	The cache is not read in this case, as the reads are needed.
+	open_options (reference, threads) are passed to open_bam when bam is not given.
+	depth_options (engine, min_mapq, keep_duplicates, keep_secondary) are passed to get_depth.
+	"""
+	# Get coverage of each base
+	with profiling.stage("bam_fetch"):
+		depth = cache.get(bam_path, chrom, start, end, depth_options) if cache is not None and junctions is None else None
+		if depth is None:
+			with contextlib.ExitStack() as stack:
+				if bam is None:
+					bam = stack.enter_context(open_bam(bam_path, **(open_options or {})))
+				try:
+					depth = get_depth(bam, chrom, start, end, junctions = junctions, **depth_options)
+				except Exception as e:
+					logger.error(f"Failed to get coverage for {chrom}:{start}-{end}")
+					logger.error(f"Error: {e}")
+					raise
+			if cache is not None:
+				cache.put(bam_path, chrom, start, end, depth_options, depth)
+		# Keep raw coverage in the smallest type (smoothed coverage has the same type with median filter)
+		coverage = compact_depth(depth)
+		del depth
+	# Apply median filter (or other smoothing method) for smooth coverage plot
+	with profiling.stage("smoothing"):
+		coverage = smooth(coverage, window_size, smoothing)
 	return coverage
+
+class CoveragePool(concurrent.futures.ProcessPoolExecutor):
+	"""
+	Process pool to calculate coverage of samples in parallel, recording its number of processes.
+	"""
+
+	def __init__(self, processes):
+		super().__init__(max_workers = processes)
+		self.processes = processes
+
+def open_coverage_pool(processes):
+	"""
+	Return a process pool to calculate coverage of samples in parallel, or None if processes <= 1.
+	"""
+	if processes is None or processes <= 1:
+		return None
+	return CoveragePool(processes)
+
+# AlignmentFile opened in each worker process of the coverage pool, keyed by BAM path
+_worker_bam_handles = {}
+
+def _coverage_worker(bam_path, chrom, start, end, window_size, smoothing, cache, count_junctions, open_options, depth_options):
+	"""
+	Calculate coverage (and junctions if count_junctions) in a worker process, reusing BAM files opened by previous tasks.
+	"""
+	bam = _worker_bam_handles.get(bam_path)
+	if bam is None:
+		bam = open_bam(bam_path, **(open_options or {}))
+		_worker_bam_handles[bam_path] = bam
+	junctions = {} if count_junctions else None
+	coverage = get_coverage(bam_path, chrom, start, end, window_size, bam, smoothing, cache, junctions, open_options, **depth_options)
+	return coverage, junctions
+
+def get_coverages(experiment_dict, samples, chrom, start, end, window_size=21, bam_handles=None, smoothing="median", pool=None, cache=None, contig_aliases=None, consumer=None, junctions_dict=None, open_options=None, **depth_options):
+	"""
+	Return coverage arrays of the specified region for each sample.
+
+	Parameters
+	- experiment_dict: dict
+		Dictionary of experiment table
+	- samples: list
+		Samples to calculate coverage for, in plotting order
+	- chrom, start, end: str, int, int
+		Target region
+	- window_size: int
+		Window size for median filter
+	- bam_handles: dict
+		Opened AlignmentFile for each sample (optional)
+	- smoothing: str
+		Smoothing method (median or mean)
+	- pool: concurrent.futures.Executor
+		Pool to calculate coverage of samples in parallel (optional, see open_coverage_pool).
+		At most as many samples as its processes are submitted at a time, so that only their coverage is held here
+	- cache: CoverageCache
+		On-disk cache of raw coverage (optional)
+	- contig_aliases: dict
+		Contig alias map of each sample (optional, see contig_aliases). Without it,
+		"chr" prefix is removed and retried when chrom is not found in the BAM file.
+	- consumer: callable
+		If given, consumer(sample, coverage) is called for each sample in the order of samples
+		and coverage is not kept (e.g. to accumulate group statistics)
+	- junctions_dict: dict
+		If given, introns of the reads are counted while calculating coverage and stored as
+		{sample: {(start, end): reads}} (0-based, half-open) in the same BAM pass
+	- open_options: dict
+		Options passed to open_bam (reference, threads) when BAM files are opened here or in worker processes
+	- depth_options: dict
+		Options passed to get_depth (engine, min_mapq, keep_duplicates, keep_secondary)
+
+	Returns
+	- coverage_dict: dict
+		{sample: coverage} in the same order as samples (empty if consumer is given)
+
+	Raises
+	- RuntimeError
+		If coverage could not be calculated for any sample. All failed samples are reported.
+	"""
+	coverage_dict = {}
+	errors = {}
+	# Get contig name in the BAM file of each sample
+	def sample_chrom(sample):
+		if contig_aliases and sample in contig_aliases:
+			return contig_aliases[sample].get(chrom, chrom)
+		return chrom
+	if pool is not None:
+		logger.info(f"{len(samples)} samples in parallel...")
+		with profiling.stage("coverage (parallel)"):
+			def submit(sample):
+				return pool.submit(_coverage_worker, experiment_dict[sample]["bam"], sample_chrom(sample), start, end, window_size, smoothing, cache, junctions_dict is not None, open_options, depth_options)
+			samples = list(samples)
+			max_in_flight = getattr(pool, "processes", len(samples))
+			futures = collections.deque((sample, submit(sample)) for sample in samples[:max_in_flight])
+			next_index = len(futures)
+			# Collect results in the order of samples, submitting the next sample as each result is taken
+			while futures:
+				sample, future = futures.popleft()
+				try:
+					coverage, junctions = future.result()
+				except Exception as e:
+					errors[sample] = e
+					coverage = None
+				del future
+				if next_index < len(samples):
+					futures.append((samples[next_index], submit(samples[next_index])))
+					next_index += 1
+				if coverage is None:
+					continue
+				if junctions_dict is not None:
+					junctions_dict[sample] = junctions
+				if consumer is not None:
+					consumer(sample, coverage)
+				else:
+					coverage_dict[sample] = coverage
+	else:
+		for sample in samples:
+			logger.info(f"{sample}...")
+			bam = bam_handles.get(sample) if bam_handles else None
+			junctions = {} if junctions_dict is not None else None
+			try:
+				with profiling.stage("coverage", sample):
+					coverage = get_coverage(experiment_dict[sample]["bam"], sample_chrom(sample), start, end, window_size, bam, smoothing, cache, junctions, open_options, **depth_options)
+			except Exception as e:
+				errors[sample] = e
+				continue
+			if junctions_dict is not None:
+				junctions_dict[sample] = junctions
+			if consumer is not None:
+				consumer(sample, coverage)
+			else:
+				coverage_dict[sample] = coverage
+	if errors:
+		for sample, e in errors.items():
+			logger.error(f"Failed to get coverage of {sample} ({experiment_dict[sample]['bam']}): {e}")
+		raise RuntimeError(f"Failed to get coverage for {chrom}:{start}-{end} of {len(errors)} samples: {','.join(errors)}")
+	return coverage_dict
+
+def get_junction_counts(experiment_dict, samples, chrom, start, end, bam_handles=None, contig_aliases=None, open_options=None, **depth_options) -> dict:
+	"""
+	Count introns of the reads of each sample in the region without calculating coverage (see count_junctions).
+
+	Returns
+	- junctions_dict: dict
+		{sample: {(start, end): reads}} (0-based, half-open), as given by get_coverages
+	"""
+	read_options = {key: value for key, value in depth_options.items() if key in ["min_mapq", "keep_duplicates", "keep_secondary"]}
+	junctions_dict = {}
+	for sample in samples:
+		sample_chrom = contig_aliases[sample].get(chrom, chrom) if contig_aliases and sample in contig_aliases else chrom
+		with contextlib.ExitStack() as stack:
+			bam = bam_handles.get(sample) if bam_handles else None
+			if bam is None:
+				bam = stack.enter_context(open_bam(experiment_dict[sample]["bam"], **(open_options or {})))
+			junctions_dict[sample] = count_junctions(bam, sample_chrom, start, end, **read_options)
+	return junctions_dict
+
+class LazyCoverages(collections.abc.Mapping):
+	"""
+	{sample: coverage} whose coverage is calculated by get_coverages when it is accessed, and not kept.
+
+	Used to stream samples through plots.sashimi, which draws and frees coverage of one sample before the next,
+	so that memory is bounded by coverage of a single sample. Arguments are the same as get_coverages.
+	"""
+
+	def __init__(self, experiment_dict, samples, chrom, start, end, window_size=21, bam_handles=None, smoothing="median", pool=None, cache=None, contig_aliases=None, open_options=None, **depth_options):
+		self.samples = list(samples)
+		self.coverage_args = (experiment_dict, chrom, start, end, window_size, bam_handles, smoothing, pool, cache, contig_aliases)
+		self.open_options = open_options
+		self.depth_options = depth_options
+
+	def __getitem__(self, sample):
+		if sample not in self.samples:
+			raise KeyError(sample)
+		experiment_dict, chrom, start, end, window_size, bam_handles, smoothing, pool, cache, contig_aliases = self.coverage_args
+		return get_coverages(experiment_dict, [sample], chrom, start, end, window_size, bam_handles, smoothing, pool, cache, contig_aliases, open_options = self.open_options, **self.depth_options)[sample]
+
+	def __iter__(self):
+		return iter(self.samples)
+
+	def __len__(self):
+		return len(self.samples)
@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+import numpy as np
+from . import bams
+
+class CoverageCache:
+	"""
+	On-disk cache of raw (unsmoothed) coverage arrays with LRU eviction.
+
+	Entries are stored as .npy files under a directory per BAM file, keyed by BAM path,
+	size and mtime of the BAM file and its index, and options to calculate depth.
+	A region contained in a cached region is answered by memory-mapping the cached array.
+	"""
+
+	def __init__(self, cache_dir, max_size_mb = 1024):
+		self.cache_dir = cache_dir
+		self.max_size = int(max_size_mb * 1024 * 1024)
+		os.makedirs(cache_dir, exist_ok = True)
+
+	def bam_dir(self, bam_path, depth_options) -> str:
+		"""
+		Return directory of cache entries for the BAM file and depth options.
+		"""
+		bam_path = os.path.abspath(bam_path)
+		key = [bam_path, sorted(depth_options.items())]
+		for path in [bam_path] + bams.index_paths(bam_path):
+			if os.path.exists(path):
+				stat = os.stat(path)
+				key.append([path, stat.st_size, stat.st_mtime_ns])
+		digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+		return os.path.join(self.cache_dir, digest)
+
+	def get(self, bam_path, chrom, start, end, depth_options):
+		"""
+		Return cached depth of the region, or None if no cached region contains it.
+		"""
+		entry_dir = self.bam_dir(bam_path, depth_options)
+		if not os.path.isdir(entry_dir):
+			return None
+		prefix = f"{chrom}_"
+		for entry in os.listdir(entry_dir):
+			if not (entry.startswith(prefix) and entry.endswith(".npy")):
+				continue
+			try:
+				entry_start, entry_end = [int(pos) for pos in entry[len(prefix):-len(".npy")].split("_")]
+			except ValueError:
+				continue
+			if entry_start <= start and end <= entry_end:
+				entry_path = os.path.join(entry_dir, entry)
+				try:
+					depth = np.load(entry_path, mmap_mode = "r")[start - entry_start:end - entry_start]
+					# Read the slice into memory in its stored type (compact unsigned integers)
+					depth = np.array(depth)
+					# Mark as recently used
+					os.utime(entry_path)
+				except (OSError, ValueError) as e:
+					logger.debug(f"Failed to read cache entry {entry_path}: {e}")
+					continue
+				logger.debug(f"Coverage cache hit: {bam_path} {chrom}:{start}-{end}")
+				return depth
+		return None
+
+	def put(self, bam_path, chrom, start, end, depth_options, depth):
+		"""
+		Store depth of the region and evict least recently used entries if the cache is full.
+		"""
+		entry_dir = self.bam_dir(bam_path, depth_options)
+		os.makedirs(entry_dir, exist_ok = True)
+		entry_path = os.path.join(entry_dir, f"{chrom}_{start}_{end}.npy")
+		tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+		# Store in the most compact unsigned integer type
+		depth = np.asarray(depth)
+		dtype = np.uint16 if depth.size == 0 or depth.max() <= np.iinfo(np.uint16).max else np.uint32
+		try:
+			with open(tmp_path, "wb") as f:
+				np.save(f, depth.astype(dtype))
+			os.replace(tmp_path, entry_path)
+		except OSError as e:
+			logger.warning(f"Failed to write coverage cache {entry_path}: {e}")
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			return
+		self.evict()
+
+	def evict(self):
+		"""
+		Remove least recently used entries until the total size is within the limit.
+		"""
+		entries = []
+		total_size = 0
+		for entry_dir in os.scandir(self.cache_dir):
+			if not entry_dir.is_dir():
+				continue
+			for entry in os.scandir(entry_dir.path):
+				if not entry.name.endswith(".npy"):
+					continue
+				try:
+					stat = entry.stat()
+				except FileNotFoundError:
+					continue
+				entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+				total_size += stat.st_size
+		if total_size <= self.max_size:
+			return
+		for mtime, size, path in sorted(entries):
+			try:
+				os.remove(path)
+				logger.debug(f"Evicted coverage cache entry: {path}")
+			except FileNotFoundError:
+				pass
+			total_size -= size
+			if total_size <= self.max_size:
+				break
@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+from . import bams
+
+# Suffix of fingerprint file written next to each output
+FINGERPRINT_SUFFIX = ".s2s_fingerprint.json"
+# Options that do not change the plot
+IGNORED_OPTIONS = [
+	"experiment", "shiba", "output", "id", "coordinate", "batch", "command", "verbose", "processes",
+	"cache_dir", "cache_size", "coverage_store", "bam_threads", "streaming", "no_index", "profile", "cprofile", "incremental", "multipage", "toc", "shard",
+	"top", "event_types", "max_q", "min_dpsi", "rank_by"
+]
+
+def file_stat(path, stat_cache = None) -> list:
+	"""
+	Return [path, size, mtime] of a file, or [path, None, None] if it does not exist.
+	"""
+	if stat_cache is not None and path in stat_cache:
+		return stat_cache[path]
+	try:
+		stat = os.stat(path)
+		entry = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+	except FileNotFoundError:
+		entry = [os.path.abspath(path), None, None]
+	if stat_cache is not None:
+		stat_cache[path] = entry
+	return entry
+
+def input_files(args, event, experiment_dict, target_samples) -> list:
+	"""
+	Return input files used to plot the event: experiment table, BAM/CRAM files and their indexes, reference FASTA, GTF, and Shiba files.
+	"""
+	paths = [args.experiment]
+	for sample in target_samples:
+		bam_path = experiment_dict[sample]["bam"]
+		paths += [bam_path] + bams.index_paths(bam_path)
+	if args.reference:
+		paths.append(args.reference)
+	if args.gtf:
+		paths.append(args.gtf)
+	if event["pos_id"]:
+		event_type = event["pos_id"].split("@")[0]
+		paths.append(os.path.join(args.shiba, "events", f"EVENT_{event_type}.txt"))
+		paths.append(os.path.join(args.shiba, "results", "splicing", "PSI_matrix_sample.txt"))
+	if not args.nojunc and args.junction_source == "shiba":
+		paths.append(os.path.join(args.shiba, "junctions", "junctions.bed"))
+	return paths
+
+def event_fingerprint(args, event, experiment_dict, target_samples, version, stat_cache = None) -> dict:
+	"""
+	Return fingerprint of the plot of the event, covering the target, plot options and inputs.
+
+	Returns
+	- fingerprint: dict
+		digest: SHA-1 of the other entries
+		target, options, inputs, version: what the digest covers
+	"""
+	fingerprint = {
+		"version": version,
+		"target": [event["pos_id"], event["coordinate"]],
+		"options": {key: value for key, value in sorted(vars(args).items()) if key not in IGNORED_OPTIONS},
+		"inputs": [file_stat(path, stat_cache) for path in input_files(args, event, experiment_dict, target_samples)]
+	}
+	fingerprint["digest"] = hashlib.sha1(json.dumps(fingerprint, sort_keys = True, default = str).encode()).hexdigest()
+	return fingerprint
+
+def is_up_to_date(output, fingerprint) -> bool:
+	"""
+	Return True if output exists and was created with the same fingerprint.
+	"""
+	if not os.path.exists(output):
+		return False
+	try:
+		with open(output + FINGERPRINT_SUFFIX) as f:
+			return json.load(f).get("digest") == fingerprint["digest"]
+	except (OSError, ValueError):
+		return False
+
+def save_fingerprint(output, fingerprint):
+	"""
+	Write fingerprint next to output.
+	"""
+	try:
+		with open(output + FINGERPRINT_SUFFIX, "w") as f:
+			json.dump(fingerprint, f, indent = 1, default = str)
+	except OSError as e:
+		logger.warning(f"Failed to write fingerprint of {output}: {e}")
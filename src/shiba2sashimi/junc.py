@@ -1,13 +1,227 @@
 import sys
 import os
+import bisect
 import logging
 # Configure logging
 logger = logging.getLogger(__name__)
+import numpy as np
+from . import utils
 
-def extract_junctions_in_region(shiba_path, chrom, start, end, junction_list = None) -> dict:
+# Suffix of sidecar index file of junctions.bed
+JUNCTION_INDEX_SUFFIX = ".s2s_index.npz"
+
+def build_junction_index(junctions_bed) -> dict:
+	"""
+	Build index of junctions.bed sorted by chromosome and start, and hashed by junction ID.
+
+	Returns
+	- index: dict
+		chroms: chromosome names
+		row_chroms, starts, ends, offsets: chromosome index, start, end, and byte offset of each junction sorted by (chromosome, start)
+		id_hashes, id_offsets: hash of junction ID and byte offset of each junction sorted by hash
+		header_offset: byte offset of the header line
+	"""
+	logger.info(f"Building index of {junctions_bed}")
+	signature = utils.file_signature(junctions_bed)
+	chrom_index = {}
+	row_chroms = []
+	starts = []
+	ends = []
+	offsets = []
+	junc_IDs = []
+	header_offset = -1
+	with open(junctions_bed, "rb") as junctions:
+		offset = 0
+		for line in junctions:
+			line_offset = offset
+			offset += len(line)
+			if line.startswith(b"chr\tstart"):
+				header_offset = line_offset
+				continue
+			if not line.strip():
+				continue
+			junc_cols = line.split(b"\t", 4)
+			junc_chrom = junc_cols[0].decode()
+			row_chroms.append(chrom_index.setdefault(junc_chrom, len(chrom_index)))
+			starts.append(int(junc_cols[1]))
+			ends.append(int(junc_cols[2]))
+			offsets.append(line_offset)
+			junc_IDs.append(junc_cols[3].strip().decode())
+	row_chroms = np.array(row_chroms, dtype=np.int32)
+	starts = np.array(starts, dtype=np.int64)
+	ends = np.array(ends, dtype=np.int64)
+	offsets = np.array(offsets, dtype=np.int64)
+	id_hashes = utils.hash_keys(junc_IDs)
+	order = np.lexsort((offsets, starts, row_chroms))
+	id_order = np.lexsort((offsets, id_hashes))
+	index = {
+		"chroms": np.array(list(chrom_index), dtype=str),
+		"row_chroms": row_chroms[order],
+		"starts": starts[order],
+		"ends": ends[order],
+		"offsets": offsets[order],
+		"id_hashes": id_hashes[id_order],
+		"id_offsets": offsets[id_order],
+		"header_offset": np.array(header_offset, dtype=np.int64)
+	}
+	utils.save_sidecar_index(junctions_bed, JUNCTION_INDEX_SUFFIX, signature, index)
+	return index
+
+def load_junction_index(junctions_bed) -> dict:
+	"""
+	Load index of junctions.bed, building it if it does not exist or the file has changed.
+	Indexes are kept in memory for later calls in the same process.
+	"""
+	return utils.load_cached_index(junctions_bed, JUNCTION_INDEX_SUFFIX, lambda: build_junction_index(junctions_bed))
+
+def query_junction_index(index, chrom, start, end, junction_list = None) -> list:
+	"""
+	Return byte offsets of junctions in the specified region (or in junction_list) using index.
+	"""
+	if junction_list:
+		offsets = set()
+		for junc_ID in junction_list:
+			offsets.update(utils.lookup_hashed_offsets(index, junc_ID, "id_hashes", "id_offsets"))
+		return sorted(offsets)
+	offsets = []
+	for junc_chrom in set([chrom, f"chr{chrom}"]):
+		chrom_idx = np.flatnonzero(index["chroms"] == junc_chrom)
+		if len(chrom_idx) == 0:
+			continue
+		lo = np.searchsorted(index["row_chroms"], chrom_idx[0], side="left")
+		hi = np.searchsorted(index["row_chroms"], chrom_idx[0], side="right")
+		# Junctions starting within the region
+		chrom_starts = index["starts"][lo:hi]
+		lo, hi = lo + np.searchsorted(chrom_starts, start, side="right"), lo + np.searchsorted(chrom_starts, end, side="left")
+		ends = index["ends"][lo:hi]
+		offsets += index["offsets"][lo:hi][(start < ends) & (ends < end)].tolist()
+	return sorted(offsets)
+
+def read_junction_lines(junctions_bed, index, offsets_list) -> tuple:
+	"""
+	Read header and junction lines at the specified byte offsets.
+
+	Returns
+	- samples: list
+		Sample names in the header
+	- lines_list: list
+		Lines for each list of offsets
+	"""
+	with open(junctions_bed, "rb") as junctions:
+		samples = []
+		header_offset = int(index["header_offset"])
+		if header_offset >= 0:
+			junctions.seek(header_offset)
+			samples = junctions.readline().decode().strip().split("\t")[4:]
+		lines_list = []
+		for offsets in offsets_list:
+			lines = []
+			for offset in offsets:
+				junctions.seek(offset)
+				lines.append(junctions.readline().decode().strip())
+			lines_list.append(lines)
+	return samples, lines_list
+
+class JunctionTable:
+	"""
+	Read numbers of junctions (rows) in samples (columns).
+
+	Attributes
+	- ids: list
+		Junction IDs (chrom:start-end with 1-based start, as in junctions.bed)
+	- starts, ends: np.ndarray
+		0-based start and end of each junction, parsed once from the IDs
+	- samples: list
+		Sample (or group) of each column
+	- counts: np.ndarray
+		Read numbers of shape (junctions, samples)
+	"""
+
+	def __init__(self, ids, samples, counts, starts = None, ends = None):
+		self.ids = list(ids)
+		self.samples = list(samples)
+		self.sample_index = {sample: i for i, sample in enumerate(self.samples)}
+		self.counts = np.asarray(counts).reshape(len(self.ids), len(self.samples))
+		if starts is None or ends is None:
+			starts = [int(junc_ID.rsplit(":", 1)[1].split("-")[0]) - 1 for junc_ID in self.ids]
+			ends = [int(junc_ID.rsplit(":", 1)[1].split("-")[1]) for junc_ID in self.ids]
+		self.starts = np.asarray(starts, dtype=np.int64)
+		self.ends = np.asarray(ends, dtype=np.int64)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __repr__(self):
+		return f"JunctionTable({len(self.ids)} junctions x {len(self.samples)} samples)"
+
+	@classmethod
+	def from_rows(cls, rows, header_samples, samples = None):
+		"""
+		Create table from {junc_ID: values} of junctions.bed lines, keeping only the columns of samples (default: all).
+		"""
+		col_dict = {sample: i for i, sample in enumerate(header_samples)}
+		samples = [sample for sample in (samples if samples is not None else header_samples) if sample in col_dict]
+		cols = [col_dict[sample] for sample in samples]
+		counts = np.array([[int(values[col]) for col in cols] for values in rows.values()], dtype=np.int64)
+		return cls(rows.keys(), samples, counts)
+
+	@classmethod
+	def from_dict(cls, junctions_dict):
+		"""
+		Create table from {sample: {junc_ID: reads}}. Missing read numbers are 0.
+		"""
+		samples = list(junctions_dict)
+		ids = list(dict.fromkeys(junc_ID for sample_junctions in junctions_dict.values() for junc_ID in sample_junctions))
+		counts = np.array([[junctions_dict[sample].get(junc_ID, 0) for sample in samples] for junc_ID in ids])
+		return cls(ids, samples, counts)
+
+	def to_dict(self) -> dict:
+		"""
+		Return {sample: {junc_ID: reads}} (empty if there are no junctions).
+		"""
+		if not self.ids:
+			return {}
+		return {sample: dict(zip(self.ids, self.counts[:, i].tolist())) for i, sample in enumerate(self.samples)}
+
+	def sample_counts(self, sample):
+		"""
+		Return read numbers of all junctions in the sample, or None if the sample is not in the table.
+		"""
+		i = self.sample_index.get(sample)
+		return self.counts[:, i] if i is not None else None
+
+	def in_region(self, start, end) -> np.ndarray:
+		"""
+		Return mask of junctions whose start and end are both within the region (exclusive).
+		"""
+		return (start < self.starts) & (self.starts < end) & (start < self.ends) & (self.ends < end)
+
+def extract_junctions_in_region(shiba_path, chrom, start, end, junction_list = None, use_index = True, samples = None) -> JunctionTable:
 	"""
 	Get read number for each junction in the specified region from Shiba output.
 	"""
+	return extract_junctions_in_regions(shiba_path, [(chrom, start, end, junction_list)], use_index, samples)[0]
+
+def extract_junctions_in_regions(shiba_path, queries, use_index = True, samples = None) -> list:
+	"""
+	Get read number for each junction in multiple regions from Shiba output.
+
+	Parameters
+	- shiba_path: str
+		Path to Shiba output directory
+	- queries: list
+		List of (chrom, start, end, junction_list). If junction_list is given,
+		junctions are selected by ID instead of by region.
+	- use_index: bool
+		Use (and build if needed) index of junctions.bed to read only the relevant lines.
+		Otherwise, junctions.bed is scanned once for all queries.
+	- samples: list
+		Samples to keep (default: all samples in junctions.bed)
+
+	Returns
+	- junction_tables: list
+		JunctionTable for each query, in the same order as queries
+	"""
 	junctions_bed = os.path.join(shiba_path, "junctions", "junctions.bed")
 	# Check if junctions.bed file exists
 	if not os.path.exists(junctions_bed):
@@ -15,8 +229,88 @@ def extract_junctions_in_region(shiba_path, chrom, start, end, junction_list = N
 		logger.error("Please double check and provide a valid Shiba output path")
 		raise FileNotFoundError(f"Junctions file not found: {junctions_bed}")
 		sys.exit(1)
-	# Initialize junction dictionary
-	junctions_dict = {}
+	if use_index:
+		header_samples, rows_list = extract_junctions_with_index(junctions_bed, queries)
+	else:
+		header_samples, rows_list = scan_junctions(junctions_bed, queries)
+	return [JunctionTable.from_rows(rows, header_samples, samples) for rows in rows_list]
+
+def junctions_from_counts(junction_counts, chrom, start, end, junction_list = None) -> JunctionTable:
+	"""
+	Convert junction read numbers counted from BAM files to JunctionTable.
+
+	Parameters
+	- junction_counts: dict
+		{sample: {(start, end): reads}} with 0-based, half-open introns (see bams.get_coverages)
+	- chrom, start, end: str, int, int
+		Target region. Junctions are selected in the same way as from junctions.bed:
+		by ID if junction_list is given, otherwise by region.
+	"""
+	samples = list(junction_counts)
+	# Junctions found in any sample are given to all samples (with 0 reads), as in junctions.bed
+	if junction_list:
+		ids = list(junction_list)
+		introns = [(int(junc_ID.rsplit(":", 1)[1].split("-")[0]) - 1, int(junc_ID.rsplit(":", 1)[1].split("-")[1])) for junc_ID in ids]
+	else:
+		introns = set()
+		for counts in junction_counts.values():
+			introns.update((junc_start, junc_end) for junc_start, junc_end in counts if (start < junc_start < end) and (start < junc_end < end))
+		introns = sorted(introns)
+		ids = [f"{chrom}:{junc_start + 1}-{junc_end}" for junc_start, junc_end in introns]
+	counts = np.array([[junction_counts[sample].get(intron, 0) for sample in samples] for intron in introns], dtype=np.int64)
+	return JunctionTable(ids, samples, counts, [intron[0] for intron in introns], [intron[1] for intron in introns])
+
+def extract_junctions_with_index(junctions_bed, queries) -> tuple:
+	"""
+	Get junction lines of multiple regions by seeking to the lines found in the index.
+
+	Returns
+	- samples: list
+		Sample names in the header of junctions.bed
+	- rows_list: list
+		{junc_ID: read numbers (str) of all samples} for each query
+	"""
+	index = load_junction_index(junctions_bed)
+	offsets_list = [query_junction_index(index, chrom, start, end, junction_list) for chrom, start, end, junction_list in queries]
+	samples, lines_list = read_junction_lines(junctions_bed, index, offsets_list)
+	rows_list = []
+	for (chrom, start, end, junction_list), lines in zip(queries, lines_list):
+		rows = {}
+		for line in lines:
+			junc_cols = line.split("\t", 4)
+			junc_ID = junc_cols[3]
+			# Different junction IDs may share the same hash
+			if junction_list and junc_ID not in junction_list:
+				continue
+			rows[junc_ID] = junc_cols[4].split("\t") if len(junc_cols) > 4 else []
+		rows_list.append(rows)
+	return samples, rows_list
+
+def scan_junctions(junctions_bed, queries) -> tuple:
+	"""
+	Get junction lines of multiple regions by scanning junctions.bed once.
+	Returns the same as extract_junctions_with_index.
+	"""
+	# Initialize junction rows for each query
+	rows_list = [{} for _ in queries]
+	samples = []
+	# Index queries by junction ID and by chromosome
+	queries_by_junc_ID = {}
+	queries_by_chrom = {}
+	for i, (chrom, start, end, junction_list) in enumerate(queries):
+		if junction_list:
+			for junc_ID in junction_list:
+				queries_by_junc_ID.setdefault(junc_ID, []).append(i)
+		else:
+			for junc_chrom in set([chrom, f"chr{chrom}"]):
+				queries_by_chrom.setdefault(junc_chrom, []).append((start, end, i))
+	# Sort regions by start so that candidate regions can be found by bisection
+	region_starts = {}
+	max_region_len = {}
+	for junc_chrom, regions in queries_by_chrom.items():
+		regions.sort()
+		region_starts[junc_chrom] = [region[0] for region in regions]
+		max_region_len[junc_chrom] = max(end - start for start, end, i in regions)
 	# Read junctions.bed file
 	with open(junctions_bed, "r") as junctions:
 		for line in junctions:
@@ -24,28 +318,27 @@ def extract_junctions_in_region(shiba_path, chrom, start, end, junction_list = N
 			# Skip header
 			if line.startswith("chr\tstart"):
 				samples = line.split("\t")[4:]
-				samples_col_dict = {sample: i for i, sample in enumerate(samples)}
 				continue
 			# Parse junction information
-			junc_cols = line.split("\t")[:4]
+			junc_cols = line.split("\t", 4)
 			junc_chrom = junc_cols[0]
-			junc_start = junc_cols[1]
-			junc_end = junc_cols[2]
 			junc_ID = junc_cols[3]
-			junction_values = line.split("\t")[4:]
-			if junction_list:
-				if junc_ID not in junction_list:
-					continue
-				for sample, col in samples_col_dict.items():
-					if sample not in junctions_dict:
-						junctions_dict[sample] = {}
-					junctions_dict[sample][junc_ID] = int(junction_values[col])
-			else:
+			matched = list(queries_by_junc_ID.get(junc_ID, []))
+			if junc_chrom in queries_by_chrom:
+				junc_start = int(junc_cols[1])
+				junc_end = int(junc_cols[2])
 				# Check if junction is within the specified region
-				if (junc_chrom == f"chr{chrom}" or junc_chrom == chrom) and (start < int(junc_start) < end) and (start < int(junc_end) < end):
-					# Get read number
-					for sample, col in samples_col_dict.items():
-						if sample not in junctions_dict:
-							junctions_dict[sample] = {}
-						junctions_dict[sample][junc_ID] = int(junction_values[col])
-	return junctions_dict
+				regions = queries_by_chrom[junc_chrom]
+				starts = region_starts[junc_chrom]
+				lo = bisect.bisect_left(starts, junc_start - max_region_len[junc_chrom])
+				hi = bisect.bisect_left(starts, junc_start)
+				for start, end, i in regions[lo:hi]:
+					if (start < junc_start < end) and (start < junc_end < end):
+						matched.append(i)
+			if not matched:
+				continue
+			# Get read number
+			junction_values = junc_cols[4].split("\t") if len(junc_cols) > 4 else []
+			for i in matched:
+				rows_list[i][junc_ID] = junction_values
+	return samples, rows_list
@@ -2,22 +2,38 @@ import argparse
 import sys
 import logging
 import time
-from . import tables, bams, plots, junc, utils
+import os
+import contextlib
+import json
+from . import tables, bams, junc, utils, profiling, aggregate, incremental, store, shards
+from .session import check_samples_and_groups, get_target_samples, resolve_event, render_event, depth_options, open_options
 # Configure logger
 logger = logging.getLogger(__name__)
 # Set version
 VERSION = "v0.1.7"
 
-def parse_args():
-	parser = argparse.ArgumentParser(
-		description=f"shiba2sashimi {VERSION} - Create Sashimi plot from Shiba output"
-	)
-
+def add_input_arguments(parser):
+	"""
+	Add arguments for input files shared by all commands.
+	"""
 	parser.add_argument("-e", "--experiment", required = True, help = "Experiment table used for Shiba")
 	parser.add_argument("-s", "--shiba", required = True, help = "Shiba working directory")
-	parser.add_argument("-o", "--output", required = True, help = "Output file")
-	parser.add_argument("--id", required = False, help = "Positional ID (pos_id) of the event to plot")
-	parser.add_argument("-c", "--coordinate", required = False, help = "Coordinates of the region to plot")
+
+def add_coverage_arguments(parser):
+	"""
+	Add arguments to calculate coverage depth shared by all commands.
+	"""
+	parser.add_argument("--coverage_engine", default = "pileup", choices = ["pileup", "blocks"], help = "Engine to calculate coverage. pileup counts bases with base quality >= 15 (AlignmentFile.count_coverage). blocks counts aligned blocks of each read and is much faster on deep BAM files. Default: %(default)s")
+	parser.add_argument("--min_mapq", default = 0, type = int, help = "Minimum mapping quality of reads to count for coverage. Default: %(default)s")
+	parser.add_argument("--keep_duplicates", action = "store_true", help = "Count reads marked as duplicates for coverage")
+	parser.add_argument("--keep_secondary", action = "store_true", help = "Count secondary alignments for coverage")
+	parser.add_argument("--reference", required = False, help = "Reference FASTA to decode CRAM files in the experiment table. Default: reference given by the header of each CRAM file (REF_PATH/REF_CACHE)")
+	parser.add_argument("--bam_threads", default = 1, type = int, help = "Number of htslib threads to decompress each BAM/CRAM file. Default: %(default)s")
+
+def add_plot_arguments(parser):
+	"""
+	Add arguments for coverage calculation and plotting shared by all commands.
+	"""
 	parser.add_argument("--samples", required = False, help = "Samples to plot. e.g. sample1,sample2,sample3 Default: all samples in the experiment table")
 	parser.add_argument("--groups", required = False, help = "Groups to plot. e.g. group1,group2,group3 Default: all groups in the experiment table. Overrides --samples")
 	parser.add_argument("--colors", required = False, help = "Colors for each group. e.g. red,orange,blue")
@@ -25,15 +41,341 @@ def parse_args():
 	parser.add_argument("--extend_up", default = 500, type = int, help = "Extend the plot upstream. Only used when not providing coordinates. Default: %(default)s")
 	parser.add_argument("--extend_down", default = 500, type = int, help = "Extend the plot downstream. Only used when not providing coordinates. Default: %(default)s")
 	parser.add_argument("--smoothing_window_size", default = 21, type = int, help = "Window size for median filter to smooth coverage plot. Greater value gives smoother plot. Default: %(default)s")
+	parser.add_argument("--smoothing_method", default = "median", choices = ["median", "mean"], help = "Method to smooth coverage plot. mean is much faster for very wide regions. Default: %(default)s")
+	add_coverage_arguments(parser)
+	parser.add_argument("-p", "--processes", "--threads", dest = "processes", default = 1, type = int, help = "Number of processes to calculate coverage of samples in parallel. Default: %(default)s")
 	parser.add_argument("--font_family", help = "Font family for labels")
+	parser.add_argument("--cache_dir", required = False, help = "Directory to cache raw coverage of BAM files. Regions within cached regions are read from the cache without reading BAM files")
+	parser.add_argument("--cache_size", default = 1024, type = float, help = "Maximum size of the coverage cache in MB. Least recently used entries are removed. Default: %(default)s")
+	parser.add_argument("--coverage_store", required = False, help = "Coverage store built by 'shiba2sashimi index-coverage' with the same coverage options. Regions are read from the store without reading BAM files")
+	parser.add_argument("--no_index", action = "store_true", help = "Do not build or use index files next to Shiba output files; scan the files instead")
 	parser.add_argument("--nolabel", action = "store_true", help = "Do not add sample labels and PSI values to the plot")
 	parser.add_argument("--nojunc", action = "store_true", help = "Do not plot junction arcs and junction read counts to the plot")
+	parser.add_argument("--junction_source", default = "shiba", choices = ["shiba", "bam"], help = "Source of junction read numbers. shiba reads junctions.bed of Shiba output. bam counts introns (N in CIGAR) of the reads fetched for coverage, in the same pass and without junctions.bed. Default: %(default)s")
 	parser.add_argument("--minimum_junc_reads", default = 1, type = int, help = "Minimum number of reads to plot a junction arc. Default: %(default)s")
+	parser.add_argument("--aggregate", choices = aggregate.AGGREGATE_METHODS, help = "Draw one track per group with mean or median coverage of its samples instead of one track per sample. Coverage of each sample is added to group statistics and discarded")
+	parser.add_argument("--band", default = "none", choices = aggregate.BAND_METHODS, help = "Band drawn around the group coverage with --aggregate. Default: %(default)s")
+	parser.add_argument("--junction_aggregate", default = "sum", choices = aggregate.JUNCTION_AGGREGATE_METHODS, help = "Junction read numbers of each group with --aggregate. Default: %(default)s")
+	parser.add_argument("--gtf", required = False, help = "GTF file to draw transcripts overlapping the region under the coverage. Indexed once next to the file (GTF + .s2s_index.npz) and rebuilt automatically when the file changes")
+	parser.add_argument("--max_transcripts", default = 10, type = int, help = "Maximum number of transcripts drawn with --gtf. Default: %(default)s")
+	parser.add_argument("--bins", type = int, help = "Number of bins to downsample coverage for plotting. 0 disables downsampling. Default: horizontal pixel count (width x dpi)")
+	parser.add_argument("--bin_method", default = "max", choices = ["max", "mean"], help = "Method to downsample coverage in each bin. max keeps peaks. Default: %(default)s")
+	parser.add_argument("--fast_render", action = "store_true", help = "Render faster when many junctions and samples are plotted: draw arcs as a single collection, rasterize coverage in PDF/SVG, use fixed margins instead of tight bounding box, and reuse figures with the same layout")
+	parser.add_argument("--streaming", action = "store_true", help = "Calculate, draw and free coverage of one sample at a time, so that memory is bounded by coverage of a single sample for very large regions and many samples. Samples are not calculated in parallel in this mode. With --junction_source bam, junctions are counted in a separate pass over the reads. Ignored with --aggregate, which already keeps only group statistics")
 	parser.add_argument("--dpi", default = 300, type = int, help = "DPI of the output figure. Default: %(default)s")
 	parser.add_argument("-v", "--verbose", action = "store_true", help = "Increase verbosity")
-	args = parser.parse_args()
+
+def parse_args(argv = None):
+	if argv is None:
+		argv = sys.argv[1:]
+	# Server mode
+	if argv and argv[0] == "serve":
+		parser = argparse.ArgumentParser(
+			prog = f"{os.path.basename(sys.argv[0])} serve",
+			description = f"shiba2sashimi {VERSION} - Serve Sashimi plot requests in JSON lines from stdin or a Unix socket"
+		)
+		add_input_arguments(parser)
+		parser.add_argument("-o", "--output", required = False, help = "Output directory for plots of requests without output path. Default: temporary directory")
+		parser.add_argument("--format", default = "png", help = "Output file format of requests without output path. Default: %(default)s")
+		parser.add_argument("--socket", required = False, help = "Path to a Unix socket to listen on. Default: read requests from stdin and write responses to stdout")
+		add_plot_arguments(parser)
+		args = parser.parse_args(argv[1:])
+		args.command = "serve"
+		return args
+	# Build coverage store
+	if argv and argv[0] == "index-coverage":
+		parser = argparse.ArgumentParser(
+			prog = f"{os.path.basename(sys.argv[0])} index-coverage",
+			description = f"shiba2sashimi {VERSION} - Build tiled coverage store of BAM files in the experiment table for --coverage_store"
+		)
+		parser.add_argument("-e", "--experiment", required = True, help = "Experiment table used for Shiba")
+		parser.add_argument("-o", "--output", required = True, help = "Output directory of the coverage store")
+		parser.add_argument("--samples", required = False, help = "Samples to index. e.g. sample1,sample2,sample3 Default: all samples in the experiment table")
+		parser.add_argument("--groups", required = False, help = "Groups to index. e.g. group1,group2,group3 Default: all groups in the experiment table. Overrides --samples")
+		parser.add_argument("--tile_size", default = store.DEFAULT_TILE_SIZE, type = int, help = "Number of bases of each tile. Default: %(default)s")
+		add_coverage_arguments(parser)
+		parser.add_argument("-p", "--processes", "--threads", dest = "processes", default = 1, type = int, help = "Number of BAM files indexed in parallel. Default: %(default)s")
+		parser.add_argument("-v", "--verbose", action = "store_true", help = "Increase verbosity")
+		args = parser.parse_args(argv[1:])
+		args.command = "index-coverage"
+		return args
+	# Merge manifests of shards
+	if argv and argv[0] == "merge-shards":
+		parser = argparse.ArgumentParser(
+			prog = f"{os.path.basename(sys.argv[0])} merge-shards",
+			description = f"shiba2sashimi {VERSION} - Combine manifests written with --shard and report missing or failed events"
+		)
+		parser.add_argument("manifests", nargs = "+", help = f"Manifests written by each shard (shard_<i>_of_<N>{shards.MANIFEST_SUFFIX} in the output directory)")
+		parser.add_argument("-o", "--output", required = False, help = "Write the combined manifest in JSON to this file")
+		parser.add_argument("-v", "--verbose", action = "store_true", help = "Increase verbosity")
+		args = parser.parse_args(argv[1:])
+		args.command = "merge-shards"
+		return args
+	parser = argparse.ArgumentParser(
+		description=f"shiba2sashimi {VERSION} - Create Sashimi plot from Shiba output",
+		epilog = "Run 'shiba2sashimi serve -h' for options of server mode, 'shiba2sashimi index-coverage -h' for building coverage store and 'shiba2sashimi merge-shards -h' for combining manifests of --shard"
+	)
+	add_input_arguments(parser)
+	parser.add_argument("-o", "--output", required = True, help = "Output file. Output directory when --batch or --top is used")
+	parser.add_argument("--id", required = False, help = "Positional ID (pos_id) of the event to plot")
+	parser.add_argument("-c", "--coordinate", required = False, help = "Coordinates of the region to plot")
+	parser.add_argument("--batch", required = False, help = "File listing positional IDs and/or coordinates to plot, one per line. Use - to read from stdin. Shiba tables and BAM files are read only once for all events")
+	parser.add_argument("--top", type = int, help = "Plot top N events in differential splicing results of Shiba (results/splicing/PSI_<event type>.txt) filtered by --event_types, --max_q and --min_dpsi and ranked by --rank_by. Output is written as with --batch")
+	parser.add_argument("--event_types", help = f"Event types to plot with --top. e.g. SE,MXE Default: all ({','.join(tables.EVENT_TYPES)})")
+	parser.add_argument("--max_q", default = 0.05, type = float, help = "Maximum q-value of events to plot with --top. Default: %(default)s")
+	parser.add_argument("--min_dpsi", default = 0.1, type = float, help = "Minimum absolute dPSI of events to plot with --top, in the same scale as the results (0-1). Default: %(default)s")
+	parser.add_argument("--rank_by", default = "q", choices = ["q", "dpsi"], help = "Rank events by ascending q-value or descending absolute dPSI with --top. Ties are broken by the other. Default: %(default)s")
+	parser.add_argument("--format", default = "png", help = "Output file format used with --batch or --top. e.g. png, pdf, svg. Default: %(default)s")
+	parser.add_argument("--multipage", action = "store_true", help = "With --batch or --top, write all plots as pages of a single PDF file given by --output. Each page is written and freed immediately")
+	parser.add_argument("--toc", action = "store_true", help = "With --multipage, add table of contents (pos_id, gene name and page number) at the beginning of the PDF")
+	parser.add_argument("--shard", required = False, metavar = "i/N", help = f"With --batch or --top, plot only the events of shard i of N (1 <= i <= N). Events are assigned by hash of pos_id (or coordinate), so shards need no coordination. A manifest of outputs, statuses and timings is written to the output directory (shard_<i>_of_<N>{shards.MANIFEST_SUFFIX})")
+	parser.add_argument("--incremental", action = "store_true", help = f"Skip plots whose output exists and was created from the same target, plot options and inputs (size and mtime of experiment table, BAM files and indexes, and Shiba files). A fingerprint is written next to each output (output + {incremental.FINGERPRINT_SUFFIX})")
+	parser.add_argument("--profile", nargs = "?", const = "", default = None, metavar = "JSON", help = "Record wall time, CPU time and peak RSS of each stage and sample, and print them as a table in the log. If a file is given, also write them in JSON. Per-sample stages are recorded when coverage is calculated in the main process (--processes 1)")
+	parser.add_argument("--cprofile", default = None, metavar = "FILE", help = "Write cProfile statistics of the whole run to this file (readable with pstats or snakeviz)")
+	add_plot_arguments(parser)
+	args = parser.parse_args(argv)
+	args.command = None
+	if args.top is not None and args.top < 1:
+		parser.error("--top must be a positive integer")
 	return args
 
+def read_targets(batch_file) -> list:
+	"""
+	Read positional IDs and/or coordinates from a file (or stdin if "-"), skipping blank and comment lines.
+	"""
+	if batch_file == "-":
+		lines = sys.stdin.readlines()
+	else:
+		if not os.path.exists(batch_file):
+			logger.error(f"Batch file not found: {batch_file}")
+			logger.error("Please double check and provide a valid batch file")
+			sys.exit(1)
+		with open(batch_file, "r") as f:
+			lines = f.readlines()
+	targets = []
+	for line in lines:
+		line = line.strip()
+		if not line or line.startswith("#"):
+			continue
+		targets.append(line.split()[0])
+	# Remove duplicates, keeping the first occurrence
+	return list(dict.fromkeys(targets))
+
+def read_top_targets(args) -> list:
+	"""
+	Return positional IDs of top events in differential splicing results of Shiba.
+	"""
+	event_types = args.event_types.split(",") if args.event_types else None
+	for event_type in event_types or []:
+		if event_type not in tables.EVENT_TYPES:
+			logger.error(f"Unknown event type: {event_type}")
+			logger.error(f"Please choose from {', '.join(tables.EVENT_TYPES)}")
+			sys.exit(1)
+	try:
+		events = tables.load_differential_events(args.shiba, event_types, args.max_q, args.min_dpsi, args.rank_by)
+	except (FileNotFoundError, ValueError):
+		sys.exit(1)
+	logger.info(f"{len(events)} events with q <= {args.max_q} and |dPSI| >= {args.min_dpsi}")
+	top_events = events[:args.top]
+	for rank, event in enumerate(top_events, start = 1):
+		logger.info(f"#{rank} {event['pos_id']} ({event['gene_name']}) dPSI = {event['dpsi']}, q = {event['q']}")
+	return [event["pos_id"] for event in top_events]
+
+def batch_output_path(output_dir, target, output_format) -> str:
+	"""
+	Return output file path for a positional ID or coordinate.
+	"""
+	name = target.replace("@", "_").replace(":", "_").replace(";", "_").replace("/", "_")
+	return os.path.join(output_dir, f"{name}.{output_format}")
+
+def write_manifest(output_dir, manifest):
+	"""
+	Write manifest of the shard to the output directory.
+	"""
+	manifest_output = shards.manifest_path(output_dir, manifest.shard_index, manifest.shard_count)
+	manifest.write(manifest_output)
+	logger.info(f"Manifest: {manifest_output}")
+
+def run_batch(args, experiment_dict, target_samples, targets = None) -> int:
+	"""
+	Plot all events listed in the batch file (or given as targets) while reading Shiba tables and BAM files only once.
+	"""
+	if targets is None:
+		targets = read_targets(args.batch)
+	# Plot only the events of this shard
+	manifest = None
+	if args.shard:
+		shard_index, shard_count = shards.parse_shard(args.shard)
+		n_all_targets = len(targets)
+		targets = shards.select_shard(targets, shard_index, shard_count)
+		logger.info(f"Shard {shard_index}/{shard_count}: {len(targets)} of {n_all_targets} events")
+		manifest = shards.ShardManifest(shard_index, shard_count, targets, n_all_targets, VERSION)
+	logger.info(f"{len(targets)} events to plot")
+	if args.multipage:
+		if os.path.dirname(args.output):
+			os.makedirs(os.path.dirname(args.output), exist_ok = True)
+	else:
+		os.makedirs(args.output, exist_ok = True)
+	# Parse Shiba tables once for all positional IDs
+	pos_ids = [target for target in targets if "@" in target]
+	events_dict = {}
+	psi_values_by_id = {}
+	failed = []
+	# Positional IDs whose EVENT file could not be read
+	unreadable = set()
+	if pos_ids:
+		logger.info("Loading events and PSI values")
+		# Read EVENT file of each event type separately, so that a missing file fails only the events of its type
+		pos_ids_by_type = {}
+		for pos_id in pos_ids:
+			pos_ids_by_type.setdefault(pos_id.split("@")[0], []).append(pos_id)
+		with profiling.stage("event_parsing"):
+			for event_type, type_pos_ids in pos_ids_by_type.items():
+				try:
+					events_dict.update(utils.load_events(type_pos_ids, args.shiba, not args.no_index))
+				except FileNotFoundError as e:
+					logger.error(f"Failed to load {len(type_pos_ids)} events of type {event_type}")
+					failed += type_pos_ids
+					unreadable.update(type_pos_ids)
+					if manifest is not None:
+						for pos_id in type_pos_ids:
+							manifest.add(pos_id, "failed", error = f"Failed to load events: {e}")
+		pos_ids = [pos_id for pos_id in pos_ids if pos_id not in unreadable]
+		with profiling.stage("psi_lookup"):
+			psi_values_by_id = tables.load_psi_values(pos_ids, args.shiba, not args.no_index)
+	# Resolve target regions
+	events = []
+	for target in targets:
+		if target in unreadable:
+			continue
+		try:
+			events.append(resolve_event(args, target, events_dict, psi_values_by_id))
+		except (ValueError, KeyError, IndexError) as e:
+			logger.error(f"Failed to resolve {target}: {e}")
+			failed.append(target)
+			if manifest is not None:
+				manifest.add(target, "failed", error = f"Failed to resolve: {e}")
+	# Skip events whose plot was created from the same inputs and options
+	fingerprints = [None] * len(events)
+	if args.incremental:
+		stat_cache = {}
+		outdated = []
+		for event in events:
+			output = batch_output_path(args.output, event["pos_id"] or event["coordinate"], args.format)
+			fingerprint = incremental.event_fingerprint(args, event, experiment_dict, target_samples, VERSION, stat_cache)
+			if incremental.is_up_to_date(output, fingerprint):
+				logger.debug(f"Up to date: {output}")
+				if manifest is not None:
+					manifest.add(event["pos_id"] or event["coordinate"], "up_to_date", output)
+				continue
+			outdated.append((event, fingerprint))
+		logger.info(f"{len(events) - len(outdated)} of {len(events)} plots are up to date")
+		events = [event for event, fingerprint in outdated]
+		fingerprints = [fingerprint for event, fingerprint in outdated]
+	# Extract junctions for all events in a single pass
+	junctions_dicts = [None] * len(events)
+	if not args.nojunc and args.junction_source == "shiba" and events:
+		logger.info("Extracting junctions in the target regions")
+		queries = [(event["chrom"], event["start"], event["end"], event["junction_list"]) for event in events]
+		with profiling.stage("junction_extraction"):
+			junctions_dicts = junc.extract_junctions_in_regions(args.shiba, queries, not args.no_index, target_samples)
+	# Open BAM files (or a pool of worker processes keeping them open) once and plot each event
+	with contextlib.ExitStack() as stack:
+		pool = bams.open_coverage_pool(args.processes)
+		if pool is not None:
+			stack.enter_context(pool)
+			bam_handles = None
+		else:
+			try:
+				bam_handles = {sample: stack.enter_context(bams.open_bam(experiment_dict[sample]["bam"], **open_options(args))) for sample in target_samples}
+			except (OSError, ValueError) as e:
+				logger.error(f"Failed to open BAM files: {e}")
+				if manifest is not None:
+					for event in events:
+						manifest.add(event["pos_id"] or event["coordinate"], "failed", error = f"Failed to open BAM files: {e}")
+					write_manifest(args.output, manifest)
+				return 1
+		# Write all plots to a single PDF, one page per event
+		pdf = None
+		if args.multipage:
+			from . import plots
+			pdf = stack.enter_context(plots.open_multipage_pdf(args.output))
+			if args.toc:
+				plots.add_toc_pages(pdf, [(event["pos_id"] or event["coordinate"], event["gene_name"]) for event in events], fig_width = args.width)
+		for n, (event, junctions_dict, fingerprint) in enumerate(zip(events, junctions_dicts, fingerprints), start = 1):
+			target = event["pos_id"] or event["coordinate"]
+			output = pdf if pdf is not None else batch_output_path(args.output, target, args.format)
+			logger.info(f"[{n}/{len(events)}] {target}")
+			start_wall = time.perf_counter()
+			try:
+				render_event(args, event, experiment_dict, target_samples, output, junctions_dict, bam_handles, pool, output_format = "pdf" if pdf is not None else None)
+			except Exception as e:
+				logger.error(f"Failed to plot {target}: {e}")
+				failed.append(target)
+				if manifest is not None:
+					manifest.add(target, "failed", output, time.perf_counter() - start_wall, str(e))
+				if pdf is not None:
+					plots.add_message_page(pdf, f"Failed to plot {target}: {e}", fig_width = args.width)
+				continue
+			if fingerprint is not None:
+				incremental.save_fingerprint(output, fingerprint)
+			if manifest is not None:
+				manifest.add(target, "ok", output, time.perf_counter() - start_wall)
+			if pdf is None:
+				logger.info(f"Output file: {output}")
+	if pdf is not None:
+		logger.info(f"Output file: {args.output}")
+	if manifest is not None:
+		write_manifest(args.output, manifest)
+	if failed:
+		logger.error(f"Failed to plot {len(failed)} of {len(targets)} events: {','.join(failed)}")
+		return 1
+	return 0
+
+def run_index_coverage(args) -> int:
+	"""
+	Build tiled coverage store of BAM files with arguments of 'shiba2sashimi index-coverage'.
+	"""
+	experiment_dict = tables.load_experiment_table(args.experiment)
+	try:
+		check_samples_and_groups(experiment_dict, args.samples, args.groups)
+	except ValueError:
+		return 1
+	target_samples = get_target_samples(experiment_dict, args.samples, args.groups)
+	logger.info(f"Building coverage store of {len(target_samples)} samples in {args.output}")
+	failed = store.build_coverage_store(experiment_dict, target_samples, args.output, args.tile_size, args.processes, open_options(args), **depth_options(args))
+	if failed:
+		logger.error(f"Failed to build coverage store of {len(failed)} samples: {','.join(failed)}")
+		return 1
+	logger.info("shiba2sashimi finished successfully")
+	return 0
+
+def run_merge_shards(args) -> int:
+	"""
+	Combine manifests of shards with arguments of 'shiba2sashimi merge-shards'.
+	"""
+	try:
+		report = shards.merge_manifests(args.manifests)
+	except (OSError, ValueError, KeyError) as e:
+		logger.error(f"Failed to merge manifests: {e}")
+		return 1
+	n_done = len(report["events"]) - len(report["failed"])
+	logger.info(f"{n_done} of {report['n_all_targets']} events done in {report['shard_count']} shards ({report['wall_seconds']:.1f} s in total)")
+	for event in report["failed"]:
+		logger.error(f"Failed: {event['target']} ({event['error']})")
+	for target in report["missing"]:
+		logger.error(f"Missing: {target}")
+	if report["missing_shards"]:
+		logger.error(f"Manifests of {len(report['missing_shards'])} shards not found: {','.join(str(shard_index) for shard_index in report['missing_shards'])}")
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent = 1)
+		logger.info(f"Output file: {args.output}")
+	if report["failed"] or report["missing"] or report["missing_shards"]:
+		return 1
+	logger.info("All events are done")
+	return 0
+
 def main():
 
 	# Get arguments
@@ -45,111 +387,135 @@ def main():
 		level = logging.DEBUG if args.verbose else logging.INFO
 	)
 
+	# Server mode
+	if args.command == "serve":
+		from .serve import run_server
+		logger.info(f"Running shiba2sashimi ({VERSION}) in server mode")
+		return run_server(args)
+
+	# Build coverage store
+	if args.command == "index-coverage":
+		logger.info(f"Running shiba2sashimi ({VERSION}) to build coverage store")
+		return run_index_coverage(args)
+
+	# Combine manifests of shards
+	if args.command == "merge-shards":
+		return run_merge_shards(args)
+
+	# Record time and memory of each stage
+	if args.profile is None and args.cprofile is None:
+		return run(args)
+	profiler = profiling.enable()
+	cprofiler = None
+	if args.cprofile:
+		import cProfile
+		cprofiler = cProfile.Profile()
+		cprofiler.enable()
+	try:
+		return run(args)
+	finally:
+		if cprofiler is not None:
+			cprofiler.disable()
+			cprofiler.dump_stats(args.cprofile)
+			logger.info(f"cProfile output: {args.cprofile}")
+		if args.profile is not None:
+			profiler.log_table()
+			if args.profile:
+				profiler.write_json(args.profile)
+				logger.info(f"Profile output: {args.profile}")
+		profiling.disable()
+
+def run(args):
+	"""
+	Create Sashimi plot(s) with arguments of 'shiba2sashimi'.
+	"""
+
 	# Validate input and config
 	logger.info(f"Running shiba2sashimi ({VERSION})")
-	time.sleep(1)
 	logger.debug(f"Arguments: {args}")
 
 	# Load experiment table
 	logger.info(f"Loading experiment table from {args.experiment}")
-	experiment_dict = tables.load_experiment_table(args.experiment)
+	with profiling.stage("load_experiment_table"):
+		experiment_dict = tables.load_experiment_table(args.experiment)
 	logger.debug(f"Experiment table: {experiment_dict}")
 
-	# Check if provided samples exist in the experiment table
-	if args.samples:
-		for sample in args.samples.split(","):
-			if sample not in experiment_dict:
-				logger.error(f"Sample not found in the experiment table: {sample}")
-				logger.error("Please double check and provide a valid sample")
-				sys.exit(1)
-	# Check if provided groups exist in the experiment table
-	if args.groups:
-		for group in args.groups.split(","):
-			if group not in set([info["group"] for info in experiment_dict.values()]):
-				logger.error(f"Group not found in the experiment table: {group}")
-				logger.error("Please double check and provide a valid group")
-				sys.exit(1)
-
-	# Get PSI values from Shiba output
-	if args.id:
-		logger.debug(f"Get PSI values for positional ID: {args.id}")
-		psi_values_dict = tables.get_psi_values(args.id, args.shiba)
+	# Check if provided samples and groups exist in the experiment table
+	try:
+		check_samples_and_groups(experiment_dict, args.samples, args.groups)
+	except ValueError:
+		sys.exit(1)
+	if args.groups and args.samples:
+		logger.info("Both --samples and --groups are provided. Ignoring --samples")
+	target_samples = get_target_samples(experiment_dict, args.samples, args.groups)
+
+	# Plot multiple events
+	if args.multipage and not (args.batch or args.top):
+		logger.error("--multipage can only be used with --batch or --top")
+		sys.exit(1)
+	if args.multipage and args.incremental:
+		logger.error("--incremental cannot be used with --multipage")
+		sys.exit(1)
+	if args.shard:
+		if not (args.batch or args.top):
+			logger.error("--shard can only be used with --batch or --top")
+			sys.exit(1)
+		if args.multipage:
+			logger.error("--shard cannot be used with --multipage")
+			sys.exit(1)
+		try:
+			shards.parse_shard(args.shard)
+		except ValueError:
+			sys.exit(1)
+	if args.batch:
+		if args.id or args.coordinate or args.top is not None:
+			logger.error("--batch cannot be used with --id, --coordinate or --top")
+			sys.exit(1)
+		status = run_batch(args, experiment_dict, target_samples)
+		if status == 0:
+			logger.info("shiba2sashimi finished successfully")
+		return status
+	if args.top is not None:
+		if args.id or args.coordinate:
+			logger.error("--top cannot be used with --id or --coordinate")
+			sys.exit(1)
+		targets = read_top_targets(args)
+		status = run_batch(args, experiment_dict, target_samples, targets)
+		if status == 0:
+			logger.info("shiba2sashimi finished successfully")
+		return status
 
 	# Get coordinates of the target region from positional ID or coordinate
 	if args.id:
-		logger.debug(f"Extracting coordinates from positional ID: {args.id}")
-		# Get coordinates from positional ID
-		chrom, start, end, strand, gene_name, junction_list, junction_direction_dict = utils.posid2int(args.id, args.shiba, args.extend_up, args.extend_down)
-		logger.debug(f"junction_list: {junction_list}")
-		if args.coordinate:
-			logger.debug(f"Using provided coordinate: {args.coordinate}")
-			# Get coordinates from provided coordinate
-			chrom, start, end = utils.coord2int(args.coordinate)
+		event = resolve_event(args, args.id, coordinate = args.coordinate)
 	elif args.coordinate:
-		logger.debug(f"Using provided coordinate: {args.coordinate}")
-		# Get coordinates from provided coordinate
-		chrom, start, end = utils.coord2int(args.coordinate)
-		strand = None
-		gene_name = None
-		junction_list = None
-		junction_direction_dict = None
+		event = resolve_event(args, args.coordinate)
 	else:
 		logger.error("Please provide either positional ID or coordinate to define the target region")
 		sys.exit(1)
 
-	# Get coverage of the target region for each sample
-	logger.info("Calculating coverage for each sample")
-	coverage_dict = {}
-	if args.groups and args.samples:
-		logger.info("Both --samples and --groups are provided. Ignoring --samples")
-	for sample, info in experiment_dict.items():
-		if args.groups:
-			if info["group"] not in args.groups.split(","):
-				continue
-		elif args.samples:
-			if sample not in args.samples.split(","):
-				continue
-		logger.info(f"{sample}...")
-		window_size = args.smoothing_window_size if args.smoothing_window_size % 2 == 1 else args.smoothing_window_size + 1
-		coverage = bams.get_coverage(info["bam"], chrom, start, end, window_size)
-		coverage_dict[sample] = coverage
-
-	# Get information of target junctions
-	if args.nojunc:
-		logger.debug("No junctions will be plotted")
-		junctions_dict = {}
-	else:
-		logger.info("Extracting junctions in the target region")
-		logger.debug(f"Target region: {chrom}:{start}-{end}")
-		junctions_dict = junc.extract_junctions_in_region(args.shiba, chrom, start, end, junction_list)
-		logger.debug(f"Junctions in the target region: {junctions_dict}")
-
-	# Create Sashimi plot
-	logger.info("Creating Sashimi plot")
-	plots.sashimi(
-		coverage_dict = coverage_dict,
-		junctions_dict = junctions_dict,
-		experiment_dict = experiment_dict,
-		samples = args.samples if not args.groups else ",".join(coverage_dict.keys()),
-		groups = args.groups,
-		colors = args.colors,
-		fig_width = args.width,
-		chrom = chrom,
-		start = start,
-		end = end,
-		output = args.output,
-		pos_id = args.id if args.id else None,
-		coordinate = args.coordinate if args.coordinate else None,
-		strand = strand,
-		gene_name = gene_name,
-		junction_direction_dict = junction_direction_dict if args.id else None,
-		psi_values_dict = psi_values_dict if args.id else None,
-		font_family = args.font_family if args.font_family else None,
-		dpi = args.dpi,
-		nolabel = args.nolabel,
-		nojunc = args.nojunc,
-		minimum_junc_reads = args.minimum_junc_reads
-	)
+	# Skip if the plot was created from the same inputs and options
+	fingerprint = None
+	if args.incremental:
+		fingerprint = incremental.event_fingerprint(args, event, experiment_dict, target_samples, VERSION)
+		if incremental.is_up_to_date(args.output, fingerprint):
+			logger.info(f"Output file is up to date: {args.output}")
+			return 0
+
+	# Calculate coverage, extract junctions and create Sashimi plot
+	pool = bams.open_coverage_pool(args.processes)
+	try:
+		render_event(args, event, experiment_dict, target_samples, args.output, pool = pool)
+		if fingerprint is not None:
+			incremental.save_fingerprint(args.output, fingerprint)
+	except RuntimeError as e:
+		logger.error(e)
+		sys.exit(1)
+	except ValueError:
+		sys.exit(1)
+	finally:
+		if pool is not None:
+			pool.shutdown()
 
 	# Finish
 	logger.info("shiba2sashimi finished successfully")
@@ -159,5 +525,4 @@ def main():
 	return 0
 
 if __name__ == "__main__":
-	main()
-
+	sys.exit(main())
@@ -1,6 +1,6 @@
-import sys
 import os
 import numpy as np
+import collections
 import logging
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -8,8 +8,11 @@ import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 from matplotlib.patches import PathPatch
+from matplotlib.collections import PathCollection
 from matplotlib.ticker import MaxNLocator, ScalarFormatter
 from matplotlib import font_manager
+from matplotlib.backends.backend_pdf import PdfPages
+from . import profiling, junc
 
 def bezier_point(t, p0, p1, p2, p3):
 	return (
@@ -19,184 +22,385 @@ def bezier_point(t, p0, p1, p2, p3):
 		t**3 * np.array(p3)
 	)
 
+# Fonts installed in the Docker image (ttf-mscorefonts-installer)
+FONT_DIR = "/usr/share/fonts/truetype/msttcorefonts/"
+_fonts_registered = False
+
+def register_fonts(font_dir = FONT_DIR):
+	"""
+	Make sure that fonts in font_dir can be found in a Docker/Singularity container.
+	Fonts are registered once per process, and only those not yet known to matplotlib. If any are added,
+	the font list is saved to the font cache of matplotlib so that later runs find them without reading the files.
+	"""
+	global _fonts_registered
+	if _fonts_registered:
+		return
+	_fonts_registered = True
+	if not os.path.isdir(font_dir):
+		return
+	known_fonts = {os.path.realpath(font.fname) for font in font_manager.fontManager.ttflist}
+	n_added = 0
+	for font_file in os.listdir(font_dir):
+		font_path = os.path.join(font_dir, font_file)
+		if font_file.endswith(".ttf") and os.path.realpath(font_path) not in known_fonts:
+			font_manager.fontManager.addfont(font_path)
+			n_added += 1
+	if n_added:
+		logger.debug(f"Registered {n_added} fonts in {font_dir}")
+		font_manager.json_dump(font_manager.fontManager, os.path.join(matplotlib.get_cachedir(), f"fontlist-v{font_manager.FontManager.__version__}.json"))
+
+# Margins (in inches) of figures with fixed layout, used instead of tight bounding box
+FIXED_LAYOUT_MARGINS = {"left": 0.6, "right": 0.2, "top": 1.0, "bottom": 0.9}
+# Height (in inches) of each transcript in the transcript track
+TRANSCRIPT_HEIGHT = 0.15
+# Extra left margin (in inches) of figures with fixed layout for transcript labels
+TRANSCRIPT_LABEL_WIDTH = 1.5
+# Figures kept for reuse by plots with the same layout, keyed by (width, number of samples, number of transcripts, fixed layout)
+MAX_FIGURE_TEMPLATES = 4
+_figure_templates = collections.OrderedDict()
+
+def create_figure(fig_width, n_samples, fixed_layout = False, reuse = False, n_transcripts = 0) -> tuple:
+	"""
+	Create figure with a coverage subplot for each sample and an x-axis subplot at the bottom.
+	If n_transcripts > 0, a subplot for transcripts is added above the x-axis subplot.
+	With fixed_layout, margins are set in inches so that the figure can be saved without tight bounding box.
+	With reuse, a figure with the same layout created before is cleared and returned instead of creating a new one.
+
+	Returns
+	- fig: matplotlib.figure.Figure
+	- sample_axes: list
+		Subplot for each sample
+	- ax_transcripts: matplotlib.axes.Axes
+		Subplot for transcripts (None if n_transcripts is 0)
+	- ax_x: matplotlib.axes.Axes
+		Subplot for x-axis
+	"""
+	key = (fig_width, n_samples, n_transcripts, fixed_layout)
+	if reuse and key in _figure_templates:
+		fig, axes = _figure_templates[key]
+		_figure_templates.move_to_end(key)
+		for ax in axes:
+			ax.clear()
+	else:
+		track_height = TRANSCRIPT_HEIGHT * n_transcripts
+		height_ratios = [1] * n_samples + ([track_height] if n_transcripts else []) + [0.05]
+		n_rows = len(height_ratios)
+		if fixed_layout:
+			fig_height = 1 * n_samples + track_height + FIXED_LAYOUT_MARGINS["top"] + FIXED_LAYOUT_MARGINS["bottom"]
+			fig = plt.figure(figsize=(fig_width, fig_height))
+			left_margin = FIXED_LAYOUT_MARGINS["left"] + (TRANSCRIPT_LABEL_WIDTH if n_transcripts else 0)
+			gs = fig.add_gridspec(
+				n_rows, 1, hspace=1.0, height_ratios=height_ratios,
+				left=left_margin / fig_width, right=1 - FIXED_LAYOUT_MARGINS["right"] / fig_width,
+				top=1 - FIXED_LAYOUT_MARGINS["top"] / fig_height, bottom=FIXED_LAYOUT_MARGINS["bottom"] / fig_height
+			)
+		else:
+			fig_height = 1 * n_samples + track_height
+			fig = plt.figure(figsize=(fig_width, fig_height))
+			gs = fig.add_gridspec(n_rows, 1, hspace=1.0, height_ratios=height_ratios)
+		# Subplots for coverage, transcripts and x-axis
+		axes = [fig.add_subplot(gs[i, 0]) for i in range(n_rows)]
+		if reuse:
+			_figure_templates[key] = (fig, axes)
+			if len(_figure_templates) > MAX_FIGURE_TEMPLATES:
+				old_fig, old_axes = _figure_templates.popitem(last=False)[1]
+				plt.close(old_fig)
+	return fig, axes[:n_samples], axes[n_samples] if n_transcripts else None, axes[-1]
+
+def draw_transcripts(ax, transcripts, start, end):
+	"""
+	Draw transcripts (see annotation.query_transcripts) one per row: exons as boxes, introns as a line with strand arrows.
+	"""
+	n_transcripts = len(transcripts)
+	arrow_spacing = (end - start) / 40
+	for i, transcript in enumerate(transcripts):
+		y = n_transcripts - i - 0.5
+		tx_start, tx_end = max(transcript["start"], start), min(transcript["end"], end)
+		ax.hlines(y, tx_start, tx_end, color="black", linewidth=0.5)
+		# Strand arrows on the introns
+		arrows = np.arange(tx_start + arrow_spacing / 2, tx_end, arrow_spacing)
+		if len(arrows) and transcript["strand"] in ["+", "-"]:
+			ax.plot(arrows, np.full(len(arrows), y), linestyle="none", marker=">" if transcript["strand"] == "+" else "<", markersize=2, color="black")
+		ax.broken_barh([(exon_start, exon_end - exon_start) for exon_start, exon_end in transcript["exons"]], (y - 0.35, 0.7), facecolors="black")
+		ax.text(-0.01, y, f"{transcript['name']} ({transcript['transcript_id']})", transform=ax.get_yaxis_transform(), fontsize=5, ha="right", va="center")
+	ax.set_xlim(start, end)
+	ax.set_ylim(0, n_transcripts)
+	ax.set_xticks([])
+	ax.set_yticks([])
+	for spine in ax.spines.values():
+		spine.set_visible(False)
+
+def open_multipage_pdf(output):
+	"""
+	Open multi-page PDF. Plots are appended as pages by passing it to sashimi as output.
+	"""
+	return PdfPages(output)
+
+def add_toc_pages(pdf, entries, lines_per_page = 40, fig_width = 8) -> int:
+	"""
+	Append table of contents listing positional ID (or coordinate), gene name and page number of each event,
+	assuming that events are written as one page each right after the contents.
+	Return number of pages added.
+
+	Parameters
+	- pdf: PdfPages
+		Multi-page PDF to append to
+	- entries: list
+		List of (pos_id or coordinate, gene_name) in the order of pages
+	"""
+	n_pages = max(1, -(-len(entries) // lines_per_page))
+	for page in range(n_pages):
+		first = page * lines_per_page
+		fig = plt.figure(figsize=(fig_width, 11))
+		fig.text(0.05, 0.95, "Contents" if page == 0 else "Contents (continued)", fontsize=14, va="top")
+		for i, (target, gene_name) in enumerate(entries[first:first + lines_per_page]):
+			y = 0.90 - i * 0.85 / lines_per_page
+			fig.text(0.05, y, target, fontsize=7, va="top", family="monospace")
+			fig.text(0.80, y, gene_name if gene_name else "", fontsize=7, va="top")
+			fig.text(0.95, y, str(n_pages + first + i + 1), fontsize=7, va="top", ha="right")
+		pdf.savefig(fig)
+		plt.close(fig)
+	return n_pages
+
+def add_message_page(pdf, message, fig_width = 8):
+	"""
+	Append a page with a message (e.g. for an event that failed to plot, to keep page numbers of the contents).
+	"""
+	fig = plt.figure(figsize=(fig_width, 2))
+	fig.text(0.5, 0.5, message, fontsize=10, ha="center", va="center", wrap=True)
+	pdf.savefig(fig)
+	plt.close(fig)
+
+def bin_coverage(cov, start, n_bins, method = "max") -> tuple:
+	"""
+	Downsample coverage to n_bins bins for plotting, taking max (to keep peaks) or mean of each bin.
+	Return x positions (last position of each bin) and binned coverage for fill_between with step="pre".
+	"""
+	cov = np.asarray(cov)
+	if not n_bins or len(cov) <= n_bins:
+		return np.arange(start, start + len(cov)), cov
+	edges = np.linspace(0, len(cov), n_bins + 1).astype(int)
+	if method == "mean":
+		binned = np.add.reduceat(cov, edges[:-1], dtype = float) / np.diff(edges)
+	else:
+		binned = np.maximum.reduceat(cov, edges[:-1])
+	return start + edges[1:] - 1, binned
+
 def sashimi(
 		coverage_dict, junctions_dict, experiment_dict, samples, groups, colors, fig_width, chrom, start, end, output,
 		pos_id = None, coordinate = None, strand = None, gene_name = None, junction_direction_dict = None, psi_values_dict = None,
-		font_family = None, dpi = 300, nolabel = False, nojunc = False, minimum_junc_reads = 1
+		font_family = None, dpi = 300, nolabel = False, nojunc = False, minimum_junc_reads = 1,
+		n_bins = None, bin_method = "max", output_format = None, fast_render = False, transcripts = None
 	):
 	"""
 	Create Sashimi plot.
+	If output is None, the figure is returned without saving. Otherwise, it is saved to output
+	(path or file object, in output_format if given) and closed.
+	Coverage is downsampled to n_bins bins (default: horizontal pixel count of the figure, 0 to disable).
+	Junction arcs are placed at exact coordinates.
+	Coverage of a group can be given as an array of (coverage, lower, upper) in rows to draw a band around it.
+	If transcripts (see annotation.query_transcripts) are given, they are drawn in a track under the coverage.
+	With fast_render, arcs of each sample are drawn as a single collection, coverage is rasterized in vector outputs,
+	the figure is laid out with fixed margins instead of tight bounding box, and figures with the same layout are reused.
 	"""
-	# Make sure that fonts can be found in a Docker/Singularity container
-	font_dir = '/usr/share/fonts/truetype/msttcorefonts/'
-	if os.path.exists(font_dir):
-		for font_file in os.listdir(font_dir):
-			if font_file.endswith('.ttf'):
-				font_manager.fontManager.addfont(os.path.join(font_dir, font_file))
+	register_fonts()
 	# Set font family
 	if font_family:
 		matplotlib.rcParams["font.family"] = font_family
 	chrom = f"chr{chrom}" if not chrom.startswith("chr") and (chrom.isdigit() or chrom in ["X", "Y", "M", "MT"]) else chrom
+	# Set number of bins to the horizontal pixel count of the figure
+	if n_bins is None:
+		n_bins = int(fig_width * dpi)
 	# Set figure size
 	n_samples = len(coverage_dict)
-	fig_height = 1 * n_samples
-	fig = plt.figure(figsize=(fig_width, fig_height))
-	# Subplots for coverage
-	gs = fig.add_gridspec(n_samples + 1, 1, hspace=1.0, height_ratios=[1] * n_samples + [0.05])
-	# Set sample order
-	sample_order = []
-	if groups:
-		groups_list = groups.split(",")
-		for group in groups_list:
-			sample_group_order = [sample for sample, info in experiment_dict.items() if info["group"] == group]
-			if samples:
-				sample_group_order = sorted(sample_group_order, key=samples.split(",").index)
-			sample_order += sample_group_order
-	elif samples:
-		sample_order = samples.split(",")
-		groups_list = []
-		for sample in sample_order:
-			if sample in experiment_dict:
-				group = experiment_dict[sample]["group"]
-				if group not in groups_list:
-					groups_list.append(group)
-	else:
-		groups_list = []
-		seen = set()
-		for info in experiment_dict.values():
-			group = info["group"]
-			if group not in seen:
-				groups_list.append(group)
-				seen.add(group)
-		if samples:
+	reuse_figure = fast_render and output is not None
+	fig, sample_axes, ax_transcripts, ax_x = create_figure(fig_width, n_samples, fixed_layout = fast_render, reuse = reuse_figure, n_transcripts = len(transcripts) if transcripts else 0)
+	# Close the figure if plotting fails (e.g. coverage of a sample could not be read with streaming)
+	try:
+		if ax_transcripts is not None:
+			draw_transcripts(ax_transcripts, transcripts, start, end)
+		# Set sample order
+		sample_order = []
+		if groups:
+			groups_list = groups.split(",")
+			for group in groups_list:
+				sample_group_order = [sample for sample, info in experiment_dict.items() if info["group"] == group]
+				if samples:
+					sample_group_order = sorted(sample_group_order, key=samples.split(",").index)
+				sample_order += sample_group_order
+		elif samples:
 			sample_order = samples.split(",")
+			groups_list = []
+			for sample in sample_order:
+				if sample in experiment_dict:
+					group = experiment_dict[sample]["group"]
+					if group not in groups_list:
+						groups_list.append(group)
 		else:
-			sample_order = list(experiment_dict.keys())
-	logger.debug(f'sample_order: {sample_order}')
-	logger.debug(f'groups_list: {groups_list}')
-	# Set colors for each group
-	colors_list = colors.split(",") if colors else ["#a6cee3", "#1f78b4", "#b2df8a", "#33a02c", "#fb9a99", "#e31a1c", "#fdbf6f", "#ff7f00", "#cab2d6", "#6a3d9a", "#ffff99", "#b15928"]
-	if len(colors_list) < len(groups_list):
-		logger.error("Number of colors is less than number of groups")
-		sys.exit(1)
-	try:
+			groups_list = []
+			seen = set()
+			for info in experiment_dict.values():
+				group = info["group"]
+				if group not in seen:
+					groups_list.append(group)
+					seen.add(group)
+			if samples:
+				sample_order = samples.split(",")
+			else:
+				sample_order = list(experiment_dict.keys())
+		logger.debug(f'sample_order: {sample_order}')
+		logger.debug(f'groups_list: {groups_list}')
+		# Set colors for each group
+		colors_list = colors.split(",") if colors else ["#a6cee3", "#1f78b4", "#b2df8a", "#33a02c", "#fb9a99", "#e31a1c", "#fdbf6f", "#ff7f00", "#cab2d6", "#6a3d9a", "#ffff99", "#b15928"]
+		if len(colors_list) < len(groups_list):
+			logger.error(f"Number of colors ({len(colors_list)}) is less than number of groups ({len(groups_list)})")
+			logger.error("Please provide at least one color for each group")
+			raise ValueError(f"Number of colors ({len(colors_list)}) is less than number of groups ({len(groups_list)})")
 		color_dict = {group: color for group, color in zip(groups_list, colors_list)}
-	except ValueError:
-		logger.error("Number of colors does not match number of groups")
-		sys.exit(1)
-	# Plot coverage for each sample
-	if nojunc == False:
-		junc_reads_max = max([max([junc_reads for junc_ID, junc_reads in region_junctions.items()]) for region_junctions in junctions_dict.values()])
-		junc_reads_min = min([min([junc_reads for junc_ID, junc_reads in region_junctions.items()]) for region_junctions in junctions_dict.values()])
-	for i, sample_name in enumerate(sample_order):
-		ax = fig.add_subplot(gs[i, 0])
-		cov = coverage_dict[sample_name]
-		cov_max = max(cov)
-		x_positions = range(start, end)
-		group = experiment_dict[sample_name]["group"]
-		color = color_dict[group]
-		ax.fill_between(x_positions, cov, step="pre", color=color, alpha=0.8)
-		# Add sample name and PSI value
-		if nolabel:
-			logger.debug(f"Sample {sample_name} is not labeled")
-		else:
-			# Add group label at the top right corner
-			# ax.text(0.99, 0.85, group, transform=ax.transAxes, fontsize=8, color=color, ha='right', va='top')
-			if psi_values_dict:
-				try:
-					psi = psi_values_dict[sample_name]
-					ax.text(0.01, 0.85, f"{sample_name} (PSI = {psi:.2f})",transform=ax.transAxes, fontsize=8, color="black")
-				except:
-					psi = "NA"
-					ax.text(0.01, 0.85, f"{sample_name} (PSI = {psi})", transform=ax.transAxes, fontsize=8, color="black")
+		# Plot coverage for each sample
+		if nojunc == False:
+			junction_table = junctions_dict if isinstance(junctions_dict, junc.JunctionTable) else junc.JunctionTable.from_dict(junctions_dict)
+			junc_reads_max = junction_table.counts.max() if junction_table.counts.size else 0
+			junc_reads_min = junction_table.counts.min() if junction_table.counts.size else 0
+			linewidth_factor = (1.5 - 0.5) / (junc_reads_max - junc_reads_min) if junc_reads_max != junc_reads_min else 1  # Scale linewidth from 0.5 to 1.5
+			junc_in_region = junction_table.in_region(start, end)
+		for i, sample_name in enumerate(sample_order):
+			ax = sample_axes[i]
+			cov = coverage_dict[sample_name]
+			# Coverage with band (coverage, lower, upper) of a group
+			band = None
+			if np.ndim(cov) == 2:
+				cov, band = cov[0], cov[1:]
+			cov_max = cov.max()
+			x_positions, binned_cov = bin_coverage(cov, start, n_bins, bin_method)
+			group = experiment_dict[sample_name]["group"]
+			color = color_dict[group]
+			if band is not None:
+				_, binned_lower = bin_coverage(band[0], start, n_bins, bin_method)
+				_, binned_upper = bin_coverage(band[1], start, n_bins, bin_method)
+				ax.fill_between(x_positions, binned_lower, binned_upper, step="pre", color=color, alpha=0.3, linewidth=0, rasterized=fast_render)
+			ax.fill_between(x_positions, binned_cov, step="pre", color=color, alpha=0.8, rasterized=fast_render)
+			# Add sample name and PSI value
+			if nolabel:
+				logger.debug(f"Sample {sample_name} is not labeled")
 			else:
-				ax.text(0.01, 0.85, f"{sample_name}", transform=ax.transAxes, fontsize=8, color="black")
-		# Plot junctions
-		if nojunc:
-			logger.debug(f"No junctions are plotted for sample {sample_name}")
-		else:
-			region_junctions = junctions_dict[sample_name]
-			for junc_ID in region_junctions:
-				# Get number of reads
-				junc_reads = region_junctions[junc_ID]
-				if junc_reads < minimum_junc_reads:
-					continue  # Skip junctions with fewer reads than the minimum
-				# Get direction of junction
-				direction = junction_direction_dict[junc_ID] if junction_direction_dict else "up"
-				# Get junction coordinates
-				junc_start = int(junc_ID.split(":")[1].split("-")[0]) - 1 # 0-based
-				junc_end = int(junc_ID.split(":")[1].split("-")[1])
-				# Ignore if junction is out of range
-				if not (start < junc_start < end and start < junc_end < end):
-					continue
-				# Draw arc
-				(x1, y1) = (junc_start, cov[junc_start - start]) if direction == "up" else (junc_start, 0)
-				(x2, y2) = (junc_end, cov[junc_end - start]) if direction == "up" else (junc_end, 0)
-				# Calculate control point for quadratic Bezier curve
-				arc_height = cov_max * 0.5
-				ctrl1 = (x1, y1 + arc_height) if direction == "up" else (x1, y1 - arc_height)
-				ctrl2 = (x2, y2 + arc_height) if direction == "up" else (x2, y2 - arc_height)
-				verts = [ (x1, y1), ctrl1, ctrl2, (x2, y2) ]
-				codes = [ Path.MOVETO, Path.CURVE4, Path.CURVE4, Path.CURVE4 ]
+				# Add group label at the top right corner
+				# ax.text(0.99, 0.85, group, transform=ax.transAxes, fontsize=8, color=color, ha='right', va='top')
+				if psi_values_dict:
+					try:
+						psi = psi_values_dict[sample_name]
+						ax.text(0.01, 0.85, f"{sample_name} (PSI = {psi:.2f})",transform=ax.transAxes, fontsize=8, color="black")
+					except:
+						psi = "NA"
+						ax.text(0.01, 0.85, f"{sample_name} (PSI = {psi})", transform=ax.transAxes, fontsize=8, color="black")
+				else:
+					ax.text(0.01, 0.85, f"{sample_name}", transform=ax.transAxes, fontsize=8, color="black")
+			# Plot junctions
+			if nojunc:
+				logger.debug(f"No junctions are plotted for sample {sample_name}")
+			else:
+				sample_junc_reads = junction_table.sample_counts(sample_name)
+				if sample_junc_reads is None:
+					sample_junc_reads = np.zeros(len(junction_table), dtype = int)
+				# Skip junctions out of range or with fewer reads than the minimum
+				junc_indices = np.flatnonzero(junc_in_region & (sample_junc_reads >= minimum_junc_reads))
 				# Set linewidth according to the number of reads
-				linewidth_factor = (1.5 - 0.5) / (junc_reads_max - junc_reads_min) if junc_reads_max != junc_reads_min else 1  # Scale linewidth from 0.5 to 1.5
-				arc_linewidth = 0.5 + (junc_reads - junc_reads_min) * linewidth_factor
-				if junc_reads == 0:
-					arc_linewidth = 0.25
-				# Create a Bezier curve patch
-				path = Path(verts, codes)
-				bezier = PathPatch(path, linewidth=arc_linewidth, edgecolor=color, facecolor='none', clip_on=False)
-				ax.add_patch(bezier)
-				# Calculate midpoint (to use as the center of the arc)
-				bx, by = bezier_point(0.5, (x1, y1), ctrl1, ctrl2, (x2, y2))
-				# Add junc_reads as text on the arc
-				ax.text(
-					bx, by, str(junc_reads),
-					fontsize=8, ha='center', va='center', color='black',
-					backgroundcolor='white', bbox=dict(facecolor='white', edgecolor='white', boxstyle='round,pad=0'),
-					clip_on=False  # Allow text to be drawn outside the axes
-				)
-		ax.set_xlim(start, end)
-		ax.set_ylim(bottom = 0, top = max(cov) * 1.4)
-		ax.set_ylabel("Coverage", fontsize=6)
-		ax.tick_params(axis='y', labelsize=6)
-		# Despine top, right, and bottom
-		ax.spines['top'].set_visible(False)
-		ax.spines['right'].set_visible(False)
-		ax.spines['bottom'].set_visible(False)
-		# Remove xticks for all samples
-		ax.set_xticks([])
-	# Create a separate x-axis at the bottom
-	ax_x = fig.add_subplot(gs[-1, 0])
-	ax_x.set_xlim(start, end)
-	ax_x.xaxis.set_major_locator(MaxNLocator(nbins=10, integer=True)) # Set number of ticks
-	# Disable scientific notation
-	formatter = ScalarFormatter(useOffset=False, useMathText=False)
-	formatter.set_scientific(False)
-	ax_x.xaxis.set_major_formatter(formatter)
-	ax_x.tick_params(axis='x', labelrotation=45, labelsize=6)
-	for label in ax_x.get_xticklabels():
-		label.set_ha('right')  # Set horizontal alignment to 'right'
-	ax_x.set_xlabel(f"Genomic coordinate ({chrom})", fontsize=10)
-	ax_x.spines['top'].set_visible(False)
-	ax_x.spines['right'].set_visible(False)
-	ax_x.spines['left'].set_visible(False)
-	ax_x.get_yaxis().set_visible(False)
-	# Put title on the top subplot
-	title = ""
-	if coordinate:
-		title += f"{chrom}:{start}-{end}"
-	if pos_id:
-		title += f"\n{pos_id}, {gene_name} ({strand})"
-	if title:
-		ax_top = fig.axes[0]
-		ax_top.annotate(
-			title,
-			xy=(0.5, 1.5),
-			xycoords='axes fraction',
-			ha='center',
-			va='bottom',
-			fontsize=12
-		)
-	# Save plot
-	plt.savefig(output, dpi=dpi, bbox_inches="tight")
+				arc_linewidths_all = np.where(sample_junc_reads == 0, 0.25, 0.5 + (sample_junc_reads - junc_reads_min) * linewidth_factor)
+				arc_paths = []
+				arc_linewidths = []
+				for k in junc_indices.tolist():
+					junc_ID = junction_table.ids[k]
+					junc_reads = sample_junc_reads[k].item()
+					# Get direction of junction
+					direction = junction_direction_dict[junc_ID] if junction_direction_dict else "up"
+					# Get junction coordinates (0-based start)
+					junc_start = junction_table.starts[k].item()
+					junc_end = junction_table.ends[k].item()
+					# Draw arc
+					(x1, y1) = (junc_start, cov[junc_start - start]) if direction == "up" else (junc_start, 0)
+					(x2, y2) = (junc_end, cov[junc_end - start]) if direction == "up" else (junc_end, 0)
+					# Calculate control point for quadratic Bezier curve
+					arc_height = cov_max * 0.5
+					ctrl1 = (x1, y1 + arc_height) if direction == "up" else (x1, y1 - arc_height)
+					ctrl2 = (x2, y2 + arc_height) if direction == "up" else (x2, y2 - arc_height)
+					verts = [ (x1, y1), ctrl1, ctrl2, (x2, y2) ]
+					codes = [ Path.MOVETO, Path.CURVE4, Path.CURVE4, Path.CURVE4 ]
+					arc_linewidth = arc_linewidths_all[k].item()
+					# Create a Bezier curve patch
+					path = Path(verts, codes)
+					if fast_render:
+						arc_paths.append(path)
+						arc_linewidths.append(arc_linewidth)
+					else:
+						bezier = PathPatch(path, linewidth=arc_linewidth, edgecolor=color, facecolor='none', clip_on=False)
+						ax.add_patch(bezier)
+					# Calculate midpoint (to use as the center of the arc)
+					bx, by = bezier_point(0.5, (x1, y1), ctrl1, ctrl2, (x2, y2))
+					# Add junc_reads as text on the arc
+					ax.text(
+						bx, by, str(junc_reads),
+						fontsize=8, ha='center', va='center', color='black',
+						backgroundcolor='white', bbox=dict(facecolor='white', edgecolor='white', boxstyle='round,pad=0'),
+						clip_on=False  # Allow text to be drawn outside the axes
+					)
+				# Draw all arcs of the sample at once
+				if arc_paths:
+					arcs = PathCollection(arc_paths, linewidths=arc_linewidths, edgecolors=color, facecolors='none', clip_on=False)
+					ax.add_collection(arcs, autolim=False)
+			ax.set_xlim(start, end)
+			ax.set_ylim(bottom = 0, top = (cov_max if band is None else max(cov_max, band[1].max())) * 1.4)
+			ax.set_ylabel("Coverage", fontsize=6)
+			ax.tick_params(axis='y', labelsize=6)
+			# Despine top, right, and bottom
+			ax.spines['top'].set_visible(False)
+			ax.spines['right'].set_visible(False)
+			ax.spines['bottom'].set_visible(False)
+			# Remove xticks for all samples
+			ax.set_xticks([])
+			# Free coverage of this sample before the next one is calculated (coverage_dict may be bams.LazyCoverages)
+			del cov, band, x_positions, binned_cov
+		# Create a separate x-axis at the bottom
+		ax_x.set_xlim(start, end)
+		ax_x.xaxis.set_major_locator(MaxNLocator(nbins=10, integer=True)) # Set number of ticks
+		# Disable scientific notation
+		formatter = ScalarFormatter(useOffset=False, useMathText=False)
+		formatter.set_scientific(False)
+		ax_x.xaxis.set_major_formatter(formatter)
+		ax_x.tick_params(axis='x', labelrotation=45, labelsize=6)
+		for label in ax_x.get_xticklabels():
+			label.set_ha('right')  # Set horizontal alignment to 'right'
+		ax_x.set_xlabel(f"Genomic coordinate ({chrom})", fontsize=10)
+		ax_x.spines['top'].set_visible(False)
+		ax_x.spines['right'].set_visible(False)
+		ax_x.spines['left'].set_visible(False)
+		ax_x.get_yaxis().set_visible(False)
+		# Put title on the top subplot
+		title = ""
+		if coordinate:
+			title += f"{chrom}:{start}-{end}"
+		if pos_id:
+			title += f"\n{pos_id}, {gene_name} ({strand})"
+		if title:
+			ax_top = fig.axes[0]
+			ax_top.annotate(
+				title,
+				xy=(0.5, 1.5),
+				xycoords='axes fraction',
+				ha='center',
+				va='bottom',
+				fontsize=12
+			)
+		# Save plot
+		if output is None:
+			return fig
+		with profiling.stage("save"):
+			if fast_render:
+				fig.savefig(output, dpi=dpi, format=output_format)
+			else:
+				fig.savefig(output, dpi=dpi, bbox_inches="tight", format=output_format)
+		if not reuse_figure:
+			plt.close(fig)
+	except Exception:
+		if not reuse_figure:
+			plt.close(fig)
+		raise
@@ -0,0 +1,118 @@
+import sys
+import json
+import time
+import contextlib
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+try:
+	import resource
+except ImportError:
+	# Not available on Windows
+	resource = None
+
+# Profiler of the current run (None if profiling is disabled)
+_profiler = None
+
+def peak_rss_mb():
+	"""
+	Return peak resident set size of this process in MB, or None if it is not available.
+	"""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Bytes on macOS, kilobytes on Linux
+	return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+class Profiler:
+	"""
+	Record wall time, CPU time and peak RSS of each stage.
+
+	Stages can be nested; a stage without sample inherits the sample of the enclosing stage.
+	"""
+
+	def __init__(self):
+		self.records = []
+		self.samples = []
+		self.start_wall = time.perf_counter()
+		self.start_cpu = time.process_time()
+
+	@contextlib.contextmanager
+	def stage(self, name, sample = None):
+		sample = sample if sample is not None else (self.samples[-1] if self.samples else None)
+		self.samples.append(sample)
+		start_wall = time.perf_counter()
+		start_cpu = time.process_time()
+		try:
+			yield
+		finally:
+			self.samples.pop()
+			self.records.append({
+				"stage": name,
+				"sample": sample,
+				"wall_seconds": time.perf_counter() - start_wall,
+				"cpu_seconds": time.process_time() - start_cpu,
+				"peak_rss_mb": peak_rss_mb()
+			})
+
+	def summary(self) -> list:
+		"""
+		Return records aggregated by stage and sample, in the order of their first appearance.
+		"""
+		summary = {}
+		for record in self.records:
+			key = (record["stage"], record["sample"])
+			if key not in summary:
+				summary[key] = {"stage": record["stage"], "sample": record["sample"], "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": None}
+			entry = summary[key]
+			entry["calls"] += 1
+			entry["wall_seconds"] += record["wall_seconds"]
+			entry["cpu_seconds"] += record["cpu_seconds"]
+			if record["peak_rss_mb"] is not None:
+				entry["peak_rss_mb"] = max(entry["peak_rss_mb"] or 0, record["peak_rss_mb"])
+		return list(summary.values())
+
+	def total(self) -> dict:
+		return {
+			"wall_seconds": time.perf_counter() - self.start_wall,
+			"cpu_seconds": time.process_time() - self.start_cpu,
+			"peak_rss_mb": peak_rss_mb()
+		}
+
+	def log_table(self):
+		"""
+		Log summary of stages as a table.
+		"""
+		rows = [[entry["stage"], entry["sample"] or "", str(entry["calls"]), f"{entry['wall_seconds']:.3f}", f"{entry['cpu_seconds']:.3f}",
+			f"{entry['peak_rss_mb']:.1f}" if entry["peak_rss_mb"] is not None else "NA"] for entry in self.summary()]
+		total = self.total()
+		rows.append(["total", "", "", f"{total['wall_seconds']:.3f}", f"{total['cpu_seconds']:.3f}", f"{total['peak_rss_mb']:.1f}" if total["peak_rss_mb"] is not None else "NA"])
+		header = ["stage", "sample", "calls", "wall (s)", "CPU (s)", "peak RSS (MB)"]
+		widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+		logger.info("Profile:")
+		for row in [header] + rows:
+			logger.info("  ".join(value.ljust(width) if i < 2 else value.rjust(width) for i, (value, width) in enumerate(zip(row, widths))))
+
+	def write_json(self, path):
+		with open(path, "w") as f:
+			json.dump({"total": self.total(), "stages": self.summary(), "records": self.records}, f, indent = 2)
+
+def enable() -> Profiler:
+	"""
+	Start profiling of this run.
+	"""
+	global _profiler
+	_profiler = Profiler()
+	return _profiler
+
+def disable():
+	global _profiler
+	_profiler = None
+
+def stage(name, sample = None):
+	"""
+	Context manager to record a stage if profiling is enabled, otherwise do nothing.
+	"""
+	if _profiler is None:
+		return contextlib.nullcontext()
+	return _profiler.stage(name, sample)
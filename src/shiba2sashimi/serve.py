@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import stat
+import base64
+import tempfile
+import socketserver
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+from .session import Session
+from .main import batch_output_path
+
+# Options that can be set for each request, overriding those given on the command line
+REQUEST_OPTIONS = [
+	"samples", "groups", "colors", "width", "extend_up", "extend_down",
+	"smoothing_window_size", "smoothing_method", "coverage_engine", "min_mapq", "keep_duplicates", "keep_secondary",
+	"font_family", "nolabel", "nojunc", "junction_source", "minimum_junc_reads", "aggregate", "band", "junction_aggregate", "bins", "bin_method", "fast_render", "streaming", "gtf", "max_transcripts", "dpi"
+]
+
+class PlotServer:
+	"""
+	Keep a Session (experiment table, BAM files and worker pool) open and create Sashimi plots for requests.
+
+	A request is a dictionary with "id" (positional ID) and/or "coordinate", and optionally
+	"output" (output path), "format", "return_image" (return base64-encoded image in the response),
+	"request_id" (echoed in the response), and any of REQUEST_OPTIONS.
+	Without "output", the image is only returned if "return_image" is set, otherwise it is saved in the output directory.
+	"""
+
+	def __init__(self, args):
+		self.args = args
+		options = {key: value for key, value in vars(args).items() if key not in ["experiment", "shiba", "output", "format", "socket", "command"]}
+		self.session = Session(args.experiment, args.shiba, **options)
+		if args.output:
+			os.makedirs(args.output, exist_ok = True)
+			self.output_dir = args.output
+		else:
+			self.output_dir = tempfile.mkdtemp(prefix = "shiba2sashimi_")
+
+	def handle(self, request) -> dict:
+		"""
+		Create Sashimi plot for a request and return response.
+		"""
+		response = {"request_id": request.get("request_id")} if "request_id" in request else {}
+		try:
+			options = {}
+			for key, value in request.items():
+				if key in REQUEST_OPTIONS:
+					options[key] = value
+				elif key not in ["id", "coordinate", "output", "format", "return_image", "request_id"]:
+					raise ValueError(f"Unknown option: {key}")
+			pos_id = request.get("id")
+			coordinate = request.get("coordinate")
+			output_format = request.get("format", self.args.format)
+			if request.get("return_image") and not request.get("output"):
+				image = self.session.render(pos_id, coordinate, output_format, **options)
+				response.update(status = "ok", image = base64.b64encode(image).decode())
+				return response
+			output = request.get("output") or batch_output_path(self.output_dir, pos_id or coordinate, output_format)
+			self.session.save(output, pos_id, coordinate, **options)
+			response.update(status = "ok", output = output)
+			if request.get("return_image"):
+				with open(output, "rb") as f:
+					response["image"] = base64.b64encode(f.read()).decode()
+		except Exception as e:
+			logger.error(f"Failed to process request {request}: {e}")
+			response.update(status = "error", error = str(e))
+		return response
+
+	def handle_line(self, line) -> str:
+		"""
+		Process a request in JSON and return response in JSON (without newline).
+		"""
+		try:
+			request = json.loads(line)
+			if not isinstance(request, dict):
+				raise ValueError("Request must be a JSON object")
+		except ValueError as e:
+			return json.dumps({"status": "error", "error": f"Invalid request: {e}"})
+		return json.dumps(self.handle(request))
+
+	def close(self):
+		self.session.close()
+
+def serve_stream(server, instream, outstream):
+	"""
+	Process JSON-lines requests from instream and write responses to outstream until EOF.
+	"""
+	for line in instream:
+		if not line.strip():
+			continue
+		outstream.write(server.handle_line(line) + "\n")
+		outstream.flush()
+
+def remove_socket(socket_path):
+	"""
+	Remove Unix socket left at socket_path. Files other than sockets are never removed.
+	"""
+	if not os.path.lexists(socket_path):
+		return
+	if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+		logger.error(f"Not a socket: {socket_path}")
+		logger.error("Please provide a path that does not exist or an old socket of shiba2sashimi serve with --socket")
+		raise FileExistsError(f"Not a socket: {socket_path}")
+	os.remove(socket_path)
+
+def serve_socket(server, socket_path):
+	"""
+	Listen on a Unix socket and process JSON-lines requests of each connection in turn.
+	"""
+	class RequestHandler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for line in self.rfile:
+				line = line.decode()
+				if not line.strip():
+					continue
+				self.wfile.write((server.handle_line(line) + "\n").encode())
+				self.wfile.flush()
+	remove_socket(socket_path)
+	with socketserver.UnixStreamServer(socket_path, RequestHandler) as socket_server:
+		logger.info(f"Listening on {socket_path}")
+		try:
+			socket_server.serve_forever()
+		except KeyboardInterrupt:
+			logger.info("Shutting down")
+		finally:
+			remove_socket(socket_path)
+
+def run_server(args) -> int:
+	"""
+	Run server mode with arguments of 'shiba2sashimi serve'.
+	"""
+	try:
+		server = PlotServer(args)
+	except (FileNotFoundError, ValueError):
+		return 1
+	try:
+		if args.socket:
+			serve_socket(server, args.socket)
+		else:
+			logger.info("Reading requests from stdin")
+			serve_stream(server, sys.stdin, sys.stdout)
+	except FileExistsError:
+		return 1
+	finally:
+		server.close()
+	return 0
@@ -0,0 +1,350 @@
+import io
+import copy
+import contextlib
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+from . import tables, bams, junc, utils, profiling, aggregate, annotation
+from .cache import CoverageCache
+from .store import CoverageStore
+
+def check_samples_and_groups(experiment_dict, samples = None, groups = None):
+	"""
+	Check if provided samples and groups exist in the experiment table.
+	"""
+	# Check if provided samples exist in the experiment table
+	if samples:
+		for sample in samples.split(","):
+			if sample not in experiment_dict:
+				logger.error(f"Sample not found in the experiment table: {sample}")
+				logger.error("Please double check and provide a valid sample")
+				raise ValueError(f"Sample not found in the experiment table: {sample}")
+	# Check if provided groups exist in the experiment table
+	if groups:
+		for group in groups.split(","):
+			if group not in set([info["group"] for info in experiment_dict.values()]):
+				logger.error(f"Group not found in the experiment table: {group}")
+				logger.error("Please double check and provide a valid group")
+				raise ValueError(f"Group not found in the experiment table: {group}")
+
+def get_target_samples(experiment_dict, samples = None, groups = None) -> list:
+	"""
+	Return samples to plot in the order of the experiment table.
+	"""
+	target_samples = []
+	for sample, info in experiment_dict.items():
+		if groups:
+			if info["group"] not in groups.split(","):
+				continue
+		elif samples:
+			if sample not in samples.split(","):
+				continue
+		target_samples.append(sample)
+	return target_samples
+
+def depth_options(args) -> dict:
+	"""
+	Return options to calculate coverage depth from arguments.
+	"""
+	return {
+		"engine": args.coverage_engine,
+		"min_mapq": args.min_mapq,
+		"keep_duplicates": args.keep_duplicates,
+		"keep_secondary": args.keep_secondary
+	}
+
+def open_options(args) -> dict:
+	"""
+	Return options to open BAM/CRAM files from arguments.
+	"""
+	return {
+		"reference": args.reference,
+		"threads": args.bam_threads
+	}
+
+def resolve_event(args, target, events_dict = None, psi_values_by_id = None, coordinate = None) -> dict:
+	"""
+	Get target region, junctions and PSI values of a positional ID or coordinate.
+	If coordinate is given with a positional ID, it overrides the region of the event.
+	"""
+	event = {
+		"pos_id": None,
+		"coordinate": None,
+		"strand": None,
+		"gene_name": None,
+		"junction_list": None,
+		"junction_direction_dict": None,
+		"psi_values_dict": None
+	}
+	if "@" in target:
+		logger.debug(f"Extracting coordinates from positional ID: {target}")
+		event["pos_id"] = target
+		event_file_col_dict = events_dict.get(target, {}) if events_dict is not None else None
+		with profiling.stage("event_parsing"):
+			chrom, start, end, strand, gene_name, junction_list, junction_direction_dict = utils.posid2int(target, args.shiba, args.extend_up, args.extend_down, event_file_col_dict, not args.no_index)
+		logger.debug(f"junction_list: {junction_list}")
+		event.update(strand = strand, gene_name = gene_name, junction_list = junction_list, junction_direction_dict = junction_direction_dict)
+		if psi_values_by_id is not None:
+			event["psi_values_dict"] = psi_values_by_id[target]
+		else:
+			with profiling.stage("psi_lookup"):
+				event["psi_values_dict"] = tables.get_psi_values(target, args.shiba, not args.no_index)
+		if coordinate:
+			logger.debug(f"Using provided coordinate: {coordinate}")
+			# Get coordinates from provided coordinate
+			event["coordinate"] = coordinate
+			chrom, start, end = utils.coord2int(coordinate)
+	else:
+		logger.debug(f"Using provided coordinate: {target}")
+		event["coordinate"] = target
+		chrom, start, end = utils.coord2int(target)
+	event.update(chrom = chrom, start = start, end = end)
+	return event
+
+def get_event_data(args, event, experiment_dict, target_samples, junctions_dict = None, bam_handles = None, pool = None, contig_aliases = None) -> tuple:
+	"""
+	Calculate coverage of the event region for each sample and extract junctions in the region.
+	With args.aggregate, coverage of each sample is added to the statistics of its group and discarded,
+	and coverage and junctions are returned for each group instead of each sample.
+
+	Returns
+	- coverage_dict: dict
+		{sample: coverage}, or {group: coverage} with args.aggregate
+		(coverage is an array of (coverage, lower, upper) in rows if args.band is given).
+		With args.streaming, bams.LazyCoverages calculating coverage of each sample when it is accessed
+	- junctions_dict: junc.JunctionTable
+		Read numbers of junctions in target samples, or in groups with args.aggregate
+	"""
+	chrom, start, end = event["chrom"], event["start"], event["end"]
+	cache = CoverageCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+	if args.coverage_store:
+		cache = CoverageStore(args.coverage_store, fallback = cache)
+	# Get coverage of the target region for each sample
+	logger.info("Calculating coverage for each sample")
+	window_size = args.smoothing_window_size if args.smoothing_window_size % 2 == 1 else args.smoothing_window_size + 1
+	junction_counts = {} if args.junction_source == "bam" and not args.nojunc else None
+	if args.aggregate:
+		sample_groups = aggregate.group_samples(experiment_dict, target_samples, args.groups)
+		accumulators = {group: aggregate.CoverageAccumulator(args.aggregate, args.band) for group in sample_groups}
+		def add_to_group(sample, coverage):
+			accumulators[experiment_dict[sample]["group"]].add(coverage)
+		samples = [sample for members in sample_groups.values() for sample in members]
+		bams.get_coverages(experiment_dict, samples, chrom, start, end, window_size, bam_handles, args.smoothing_method, pool, cache, contig_aliases, add_to_group, junction_counts, open_options(args), **depth_options(args))
+		coverage_dict = {group: accumulator.result() for group, accumulator in accumulators.items()}
+	elif args.streaming:
+		# Coverage of each sample is calculated when it is plotted; junctions are counted beforehand without coverage
+		coverage_dict = bams.LazyCoverages(experiment_dict, target_samples, chrom, start, end, window_size, bam_handles, args.smoothing_method, pool, cache, contig_aliases, open_options(args), **depth_options(args))
+		if junction_counts is not None:
+			junction_counts.update(bams.get_junction_counts(experiment_dict, target_samples, chrom, start, end, bam_handles, contig_aliases, open_options(args), **depth_options(args)))
+	else:
+		coverage_dict = bams.get_coverages(experiment_dict, target_samples, chrom, start, end, window_size, bam_handles, args.smoothing_method, pool, cache, contig_aliases, junctions_dict = junction_counts, open_options = open_options(args), **depth_options(args))
+
+	# Get information of target junctions
+	if args.nojunc:
+		logger.debug("No junctions will be plotted")
+		junctions_dict = junc.JunctionTable([], [], [])
+	elif junction_counts is not None:
+		# Junctions counted from the reads fetched for coverage
+		junctions_dict = junc.junctions_from_counts(junction_counts, chrom, start, end, event["junction_list"])
+	elif junctions_dict is None:
+		logger.info("Extracting junctions in the target region")
+		logger.debug(f"Target region: {chrom}:{start}-{end}")
+		with profiling.stage("junction_extraction"):
+			junctions_dict = junc.extract_junctions_in_region(args.shiba, chrom, start, end, event["junction_list"], not args.no_index, target_samples)
+	if args.aggregate and junctions_dict:
+		junctions_dict = aggregate.aggregate_junctions(junctions_dict, sample_groups, args.junction_aggregate)
+	logger.debug(f"Junctions in the target region: {junctions_dict.to_dict()}")
+	return coverage_dict, junctions_dict
+
+def plot_event(args, event, experiment_dict, coverage_dict, junctions_dict, output = None, output_format = None):
+	"""
+	Create Sashimi plot of the event.
+	Return matplotlib Figure if output is None, otherwise save the plot to output (path or file object) and close it.
+	"""
+	chrom, start, end = event["chrom"], event["start"], event["end"]
+	samples = args.samples if not args.groups else ",".join(coverage_dict.keys())
+	groups = args.groups
+	psi_values_dict = event["psi_values_dict"]
+	if args.aggregate:
+		# Plot each group as a sample
+		sample_groups = aggregate.group_samples(experiment_dict, get_target_samples(experiment_dict, args.samples, args.groups), args.groups)
+		experiment_dict = {group: {"bam": None, "group": group} for group in coverage_dict}
+		samples = ",".join(coverage_dict.keys())
+		groups = None
+		if psi_values_dict:
+			psi_values_dict = aggregate.aggregate_psi_values(psi_values_dict, sample_groups)
+	# Transcripts overlapping the region
+	transcripts = None
+	if args.gtf:
+		with profiling.stage("annotation"):
+			transcripts = annotation.get_transcripts(args.gtf, chrom, start, end, args.max_transcripts)
+	logger.info("Creating Sashimi plot")
+	with profiling.stage("plotting"):
+		# Imported here as matplotlib takes most of the start-up time
+		from . import plots
+		return plots.sashimi(
+			coverage_dict = coverage_dict,
+			junctions_dict = junctions_dict,
+			experiment_dict = experiment_dict,
+			samples = samples,
+			groups = groups,
+			colors = args.colors,
+			fig_width = args.width,
+			chrom = chrom,
+			start = start,
+			end = end,
+			output = output,
+			pos_id = event["pos_id"],
+			coordinate = event["coordinate"],
+			strand = event["strand"],
+			gene_name = event["gene_name"],
+			junction_direction_dict = event["junction_direction_dict"],
+			psi_values_dict = psi_values_dict,
+			font_family = args.font_family if args.font_family else None,
+			dpi = args.dpi,
+			nolabel = args.nolabel,
+			nojunc = args.nojunc,
+			minimum_junc_reads = args.minimum_junc_reads,
+			n_bins = args.bins,
+			bin_method = args.bin_method,
+			output_format = output_format,
+			fast_render = args.fast_render,
+			transcripts = transcripts
+		)
+
+def render_event(args, event, experiment_dict, target_samples, output, junctions_dict = None, bam_handles = None, pool = None, contig_aliases = None, output_format = None):
+	"""
+	Calculate coverage of the event region and create Sashimi plot.
+	output can be a path, a file object, or PdfPages to append the plot as a page.
+	"""
+	coverage_dict, junctions_dict = get_event_data(args, event, experiment_dict, target_samples, junctions_dict, bam_handles, pool, contig_aliases)
+	plot_event(args, event, experiment_dict, coverage_dict, junctions_dict, output, output_format)
+
+class Session:
+	"""
+	Keep experiment table and BAM files open to create Sashimi plots from Python.
+
+	Options are the same as the command line options (e.g. groups="Ref,Alt", width=10, nojunc=True)
+	and can be overridden for each call.
+
+	Example:
+		with Session("experiment.tsv", "path/to/shiba") as session:
+			fig = session.figure(pos_id="SE@chr2@157561213-157561293@157560260-157561542")
+			svg = session.render(coordinate="chr2:157560000-157562000", format="svg")
+			data = session.get_data(pos_id="SE@chr2@157561213-157561293@157560260-157561542")
+	"""
+
+	def __init__(self, experiment, shiba, **options):
+		# Defaults are taken from the command line parser
+		from .main import parse_args
+		self.args = parse_args(["-e", experiment, "-s", shiba, "-o", ""])
+		self.args = self.options(**options)
+		logger.info(f"Loading experiment table from {experiment}")
+		self.experiment_dict = tables.load_experiment_table(experiment)
+		check_samples_and_groups(self.experiment_dict, self.args.samples, self.args.groups)
+		self.stack = contextlib.ExitStack()
+		self.pool = bams.open_coverage_pool(self.args.processes)
+		if self.pool is not None:
+			self.stack.enter_context(self.pool)
+		self.bam_handles = {}
+		self.contig_aliases = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		"""
+		Close BAM files and worker processes.
+		"""
+		self.stack.close()
+		self.bam_handles = {}
+
+	def options(self, **options):
+		"""
+		Return arguments of this session with options overridden.
+		"""
+		args = copy.copy(self.args)
+		for key, value in options.items():
+			if key not in vars(args):
+				raise ValueError(f"Unknown option: {key}")
+			setattr(args, key, value)
+		return args
+
+	def open_bams(self, target_samples) -> dict:
+		"""
+		Open BAM files of target samples not opened yet and build their contig alias maps.
+		Return opened BAM files of target samples, or None when coverage is calculated by worker processes.
+		"""
+		for sample in target_samples:
+			if sample in self.contig_aliases:
+				continue
+			bam_path = self.experiment_dict[sample]["bam"]
+			if self.pool is not None:
+				# BAM files are opened in worker processes; only read the header here
+				with bams.open_bam(bam_path, self.args.reference) as bam:
+					self.contig_aliases[sample] = bams.contig_aliases(bam)
+			else:
+				bam = self.stack.enter_context(bams.open_bam(bam_path, **open_options(self.args)))
+				self.bam_handles[sample] = bam
+				self.contig_aliases[sample] = bams.contig_aliases(bam)
+		if self.pool is not None:
+			return None
+		return {sample: self.bam_handles[sample] for sample in target_samples}
+
+	def resolve(self, pos_id = None, coordinate = None, **options) -> dict:
+		"""
+		Return target region, junctions and PSI values of a positional ID and/or coordinate.
+		"""
+		args = self.options(**options)
+		if pos_id:
+			return resolve_event(args, pos_id, coordinate = coordinate)
+		if coordinate:
+			return resolve_event(args, coordinate)
+		raise ValueError("Please provide either positional ID or coordinate to define the target region")
+
+	def get_data(self, pos_id = None, coordinate = None, **options) -> dict:
+		"""
+		Return event information, coverage and junctions used for the plot.
+
+		Returns
+		- data: dict
+			{"event": dict, "coverage": {sample: coverage}, "junctions": junc.JunctionTable}
+			(JunctionTable.to_dict() returns junctions as {sample: {junc_ID: int}})
+		"""
+		args = self.options(**options)
+		check_samples_and_groups(self.experiment_dict, args.samples, args.groups)
+		target_samples = get_target_samples(self.experiment_dict, args.samples, args.groups)
+		event = self.resolve(pos_id, coordinate, **options)
+		bam_handles = self.open_bams(target_samples)
+		coverage_dict, junctions_dict = get_event_data(args, event, self.experiment_dict, target_samples, bam_handles = bam_handles, pool = self.pool, contig_aliases = self.contig_aliases)
+		return {"event": event, "coverage": coverage_dict, "junctions": junctions_dict}
+
+	def figure(self, pos_id = None, coordinate = None, **options):
+		"""
+		Return Sashimi plot as matplotlib Figure. Close it with matplotlib.pyplot.close when done.
+		"""
+		args = self.options(**options)
+		data = self.get_data(pos_id, coordinate, **options)
+		return plot_event(args, data["event"], self.experiment_dict, data["coverage"], data["junctions"])
+
+	def render(self, pos_id = None, coordinate = None, format = "png", **options) -> bytes:
+		"""
+		Return Sashimi plot as bytes in the specified format (e.g. png, svg, pdf).
+		"""
+		args = self.options(**options)
+		data = self.get_data(pos_id, coordinate, **options)
+		buffer = io.BytesIO()
+		plot_event(args, data["event"], self.experiment_dict, data["coverage"], data["junctions"], buffer, format)
+		return buffer.getvalue()
+
+	def save(self, output, pos_id = None, coordinate = None, **options) -> str:
+		"""
+		Save Sashimi plot to output and return the path.
+		"""
+		args = self.options(**options)
+		data = self.get_data(pos_id, coordinate, **options)
+		plot_event(args, data["event"], self.experiment_dict, data["coverage"], data["junctions"], output)
+		return output
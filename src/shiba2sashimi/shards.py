@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import hashlib
+import logging
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Suffix of manifest file written by each shard
+MANIFEST_SUFFIX = ".s2s_manifest.json"
+# Statuses of events in manifests; events with other statuses (or without a record) are reported by merge
+DONE_STATUSES = ["ok", "up_to_date"]
+
+def parse_shard(shard) -> tuple:
+	"""
+	Parse shard specification "i/N" (1 <= i <= N).
+
+	Returns
+	- shard_index, shard_count: int, int
+	"""
+	try:
+		shard_index, shard_count = [int(value) for value in shard.split("/")]
+	except ValueError:
+		shard_index, shard_count = 0, 0
+	if not 1 <= shard_index <= shard_count:
+		logger.error(f"Invalid shard: {shard}")
+		logger.error("Please specify shard as i/N with 1 <= i <= N (e.g. 1/10)")
+		raise ValueError(f"Invalid shard: {shard}")
+	return shard_index, shard_count
+
+def shard_of(target, shard_count) -> int:
+	"""
+	Return shard (1-based) of a positional ID or coordinate, determined only by the target itself
+	so that shards agree on the assignment without coordination.
+	"""
+	return int(hashlib.sha1(target.encode()).hexdigest(), 16) % shard_count + 1
+
+def select_shard(targets, shard_index, shard_count) -> list:
+	"""
+	Return targets assigned to the shard, in the original order.
+	"""
+	return [target for target in targets if shard_of(target, shard_count) == shard_index]
+
+def manifest_path(output_dir, shard_index, shard_count) -> str:
+	return os.path.join(output_dir, f"shard_{shard_index}_of_{shard_count}{MANIFEST_SUFFIX}")
+
+class ShardManifest:
+	"""
+	Record of outputs, statuses and timings of the events of a shard.
+	"""
+
+	def __init__(self, shard_index, shard_count, targets, n_all_targets, version = None):
+		self.shard_index = shard_index
+		self.shard_count = shard_count
+		self.targets = list(targets)
+		self.n_all_targets = n_all_targets
+		self.version = version
+		self.events = {}
+		self.start_wall = time.perf_counter()
+
+	def add(self, target, status, output = None, seconds = None, error = None):
+		self.events[target] = {"target": target, "status": status, "output": output, "seconds": seconds, "error": error}
+
+	def write(self, path):
+		manifest = {
+			"version": self.version,
+			"shard": [self.shard_index, self.shard_count],
+			"n_all_targets": self.n_all_targets,
+			"targets": self.targets,
+			"wall_seconds": time.perf_counter() - self.start_wall,
+			"events": [self.events[target] for target in self.targets if target in self.events]
+		}
+		with open(path, "w") as f:
+			json.dump(manifest, f, indent = 1)
+
+def merge_manifests(manifest_paths) -> dict:
+	"""
+	Combine manifests of shards and find missing shards, and failed or missing events.
+
+	Returns
+	- report: dict
+		shard_count, n_all_targets: from the manifests
+		missing_shards: shards without manifest (their events are unknown)
+		events: records of all events in the manifests
+		failed: records of events whose status is not in DONE_STATUSES
+		missing: targets of the shards without a record (e.g. the shard was interrupted)
+		wall_seconds: sum of wall time of the shards
+	"""
+	manifests = {}
+	for path in manifest_paths:
+		with open(path) as f:
+			manifest = json.load(f)
+		shard_index, shard_count = manifest["shard"]
+		if manifests and shard_count != next(iter(manifests.values()))["shard"][1]:
+			logger.error(f"Number of shards of {path} ({shard_count}) differs from the other manifests")
+			logger.error("Please merge manifests of the same run")
+			raise ValueError(f"Number of shards of {path} ({shard_count}) differs from the other manifests")
+		if shard_index in manifests:
+			logger.warning(f"Duplicate manifest of shard {shard_index}/{shard_count}: {path}")
+		manifests[shard_index] = manifest
+	if not manifests:
+		raise ValueError("No manifests to merge")
+	shard_count = next(iter(manifests.values()))["shard"][1]
+	events = []
+	missing = []
+	for shard_index in sorted(manifests):
+		manifest = manifests[shard_index]
+		recorded = {event["target"] for event in manifest["events"]}
+		events += manifest["events"]
+		missing += [target for target in manifest["targets"] if target not in recorded]
+	return {
+		"shard_count": shard_count,
+		"n_all_targets": max(manifest["n_all_targets"] for manifest in manifests.values()),
+		"missing_shards": [shard_index for shard_index in range(1, shard_count + 1) if shard_index not in manifests],
+		"events": events,
+		"failed": [event for event in events if event["status"] not in DONE_STATUSES],
+		"missing": missing,
+		"wall_seconds": sum(manifest["wall_seconds"] for manifest in manifests.values())
+	}
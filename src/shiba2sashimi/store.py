@@ -0,0 +1,178 @@
+import os
+import json
+import hashlib
+import logging
+import concurrent.futures
+# Configure logging
+logger = logging.getLogger(__name__)
+import numpy as np
+from . import bams
+
+# Version of the coverage store layout
+STORE_VERSION = 1
+# Default number of bases of each tile
+DEFAULT_TILE_SIZE = 1 << 16
+# Tile kinds in the tile index of each contig
+EMPTY_TILE, UINT16_TILE, UINT32_TILE = 0, 1, 2
+
+def bam_key(bam_path) -> str:
+	"""
+	Return directory name of the BAM file in the store.
+	"""
+	return hashlib.sha1(os.path.abspath(bam_path).encode()).hexdigest()
+
+def bam_signature(bam_path) -> list:
+	"""
+	Return size and mtime of the BAM file to detect changes.
+	"""
+	stat = os.stat(bam_path)
+	return [stat.st_size, stat.st_mtime_ns]
+
+def build_bam_store(bam_path, store_dir, tile_size = DEFAULT_TILE_SIZE, sample = None, open_options = None, **depth_options) -> str:
+	"""
+	Build tiled depth store of a BAM file.
+
+	Depth of each contig is split into tiles of tile_size bases. Tiles without coverage are not stored,
+	and the others are appended to <contig>.u16 or <contig>.u32 (raw arrays of the smallest type that fits).
+	<contig>.tiles.npy holds kind (EMPTY_TILE, UINT16_TILE or UINT32_TILE) and slot of each tile,
+	and manifest.json holds the BAM signature, depth options and contig lengths.
+	Return directory of the store of the BAM file.
+	"""
+	bams.check_bam(bam_path, (open_options or {}).get("reference") if bams.is_cram(bam_path) else None)
+	entry_dir = os.path.join(store_dir, bam_key(bam_path))
+	os.makedirs(entry_dir, exist_ok = True)
+	manifest = {
+		"version": STORE_VERSION,
+		"sample": sample,
+		"bam": os.path.abspath(bam_path),
+		"signature": bam_signature(bam_path),
+		"depth_options": dict(sorted(depth_options.items())),
+		"tile_size": tile_size,
+		"contigs": {}
+	}
+	with bams.open_bam(bam_path, **(open_options or {})) as bam:
+		for contig, length in zip(bam.references, bam.lengths):
+			n_tiles = -(-length // tile_size)
+			tiles = np.zeros((n_tiles, 2), dtype = np.int64)
+			slots = {UINT16_TILE: 0, UINT32_TILE: 0}
+			contig_name = contig.replace(os.sep, "_")
+			with open(os.path.join(entry_dir, f"{contig_name}.u16"), "wb") as u16, open(os.path.join(entry_dir, f"{contig_name}.u32"), "wb") as u32:
+				for i in range(n_tiles):
+					tile_start = i * tile_size
+					depth = bams.get_depth(bam, contig, tile_start, min(tile_start + tile_size, length), **depth_options)
+					if not depth.any():
+						continue
+					# Last tile is padded to tile_size
+					tile = np.zeros(tile_size, dtype = np.int64)
+					tile[:len(depth)] = depth
+					kind = UINT16_TILE if tile.max() <= np.iinfo(np.uint16).max else UINT32_TILE
+					if kind == UINT16_TILE:
+						u16.write(tile.astype(np.uint16).tobytes())
+					else:
+						u32.write(tile.astype(np.uint32).tobytes())
+					tiles[i] = [kind, slots[kind]]
+					slots[kind] += 1
+			np.save(os.path.join(entry_dir, f"{contig_name}.tiles.npy"), tiles)
+			manifest["contigs"][contig] = {"length": length, "file": contig_name}
+			logger.debug(f"{bam_path} {contig}: {slots[UINT16_TILE] + slots[UINT32_TILE]} of {n_tiles} tiles stored")
+	# Write manifest last so that incomplete stores are not used
+	with open(os.path.join(entry_dir, "manifest.json"), "w") as f:
+		json.dump(manifest, f, indent = 1)
+	return entry_dir
+
+def build_coverage_store(experiment_dict, samples, store_dir, tile_size = DEFAULT_TILE_SIZE, processes = 1, open_options = None, **depth_options) -> list:
+	"""
+	Build tiled depth store of the BAM file of each sample, in parallel if processes > 1.
+	Return samples that failed.
+	"""
+	os.makedirs(store_dir, exist_ok = True)
+	failed = []
+	with concurrent.futures.ProcessPoolExecutor(max_workers = max(processes, 1)) as pool:
+		futures = {
+			sample: pool.submit(build_bam_store, experiment_dict[sample]["bam"], store_dir, tile_size, sample, open_options, **depth_options)
+			for sample in samples
+		}
+		for sample, future in futures.items():
+			try:
+				future.result()
+				logger.info(f"{sample} done")
+			except Exception as e:
+				logger.error(f"Failed to build coverage store of {sample} ({experiment_dict[sample]['bam']}): {e}")
+				failed.append(sample)
+	return failed
+
+class CoverageStore:
+	"""
+	Read-only access to tiled depth stores built by build_coverage_store.
+
+	Used in place of CoverageCache by bams.get_coverage: regions are read by memory-mapping only the tiles they touch.
+	Stores of BAM files changed after the build, or built with other depth options, are not used.
+	Requests not found in the store are passed to fallback (e.g. CoverageCache) if given.
+	"""
+
+	def __init__(self, store_dir, fallback = None):
+		self.store_dir = store_dir
+		self.fallback = fallback
+		self.manifests = {}
+
+	def manifest(self, bam_path, depth_options):
+		"""
+		Return manifest of the store of the BAM file if it is up to date and built with depth_options, otherwise None.
+		"""
+		if bam_path not in self.manifests:
+			manifest = None
+			entry_dir = os.path.join(self.store_dir, bam_key(bam_path))
+			try:
+				with open(os.path.join(entry_dir, "manifest.json")) as f:
+					manifest = json.load(f)
+				if manifest.get("version") != STORE_VERSION or manifest["signature"] != bam_signature(bam_path):
+					logger.warning(f"Coverage store of {bam_path} is outdated. Please run index-coverage again")
+					manifest = None
+				else:
+					manifest["dir"] = entry_dir
+			except (OSError, ValueError, KeyError):
+				logger.debug(f"Coverage store not found: {bam_path}")
+			self.manifests[bam_path] = manifest
+		manifest = self.manifests[bam_path]
+		if manifest is None or manifest["depth_options"] != dict(sorted(depth_options.items())):
+			return None
+		return manifest
+
+	def get(self, bam_path, chrom, start, end, depth_options):
+		"""
+		Return depth of the region from the store, or None if it is not in the store.
+		"""
+		depth = self.read(bam_path, chrom, start, end, depth_options)
+		if depth is None and self.fallback is not None:
+			return self.fallback.get(bam_path, chrom, start, end, depth_options)
+		return depth
+
+	def put(self, bam_path, chrom, start, end, depth_options, depth):
+		if self.fallback is not None:
+			self.fallback.put(bam_path, chrom, start, end, depth_options, depth)
+
+	def read(self, bam_path, chrom, start, end, depth_options):
+		manifest = self.manifest(bam_path, depth_options)
+		if manifest is None:
+			return None
+		contig = chrom if chrom in manifest["contigs"] else chrom.replace("chr", "")
+		if contig not in manifest["contigs"]:
+			return None
+		contig_info = manifest["contigs"][contig]
+		tile_size = manifest["tile_size"]
+		path = os.path.join(manifest["dir"], contig_info["file"])
+		tiles = np.load(f"{path}.tiles.npy", mmap_mode = "r")
+		depth = np.zeros(end - start, dtype = np.uint32)
+		first_tile, last_tile = start // tile_size, min((end - 1) // tile_size, len(tiles) - 1)
+		for i in range(first_tile, last_tile + 1):
+			kind, slot = tiles[i]
+			if kind == EMPTY_TILE:
+				continue
+			dtype = np.uint16 if kind == UINT16_TILE else np.uint32
+			suffix = ".u16" if kind == UINT16_TILE else ".u32"
+			tile = np.memmap(path + suffix, dtype = dtype, mode = "r", offset = int(slot) * tile_size * np.dtype(dtype).itemsize, shape = (tile_size,))
+			tile_start = i * tile_size
+			lo, hi = max(start, tile_start), min(end, tile_start + tile_size)
+			depth[lo - start:hi - start] = tile[lo - tile_start:hi - tile_start]
+		logger.debug(f"Coverage store hit: {bam_path} {chrom}:{start}-{end}")
+		return depth
@@ -3,6 +3,7 @@ import sys
 import logging
 # Configure logging
 logger = logging.getLogger(__name__)
+from . import utils
 
 def load_experiment_table(experiment_table) -> dict:
 	"""
@@ -37,20 +38,23 @@ def load_experiment_table(experiment_table) -> dict:
 			}
 	return experiment_dict
 
-def get_psi_values(positional_id, shiba_path) -> dict:
+def load_psi_values(positional_ids, shiba_path, use_index=True) -> dict:
 	"""
-	Load PSI values from PSI file
+	Load PSI values of multiple events from PSI file
 
 	Parameters
-	- positional_id: str
-		Positional ID (e.g. SE@chr1:1000-2000)
+	- positional_ids: list
+		Positional IDs (e.g. SE@chr1:1000-2000)
 	- shiba_path: str
 		Path to Shiba output directory
+	- use_index: bool
+		Read only the lines of the requested events using the index of PSI file (built if needed).
+		Otherwise, PSI file is scanned once until all events are found.
 
 	Returns
-	- psi_values_dict: dict
-		Dictionary of PSI values
-		{sample: psi}
+	- psi_values_by_id: dict
+		Dictionary of PSI values for each positional ID
+		{positional_id: {sample: psi}}
 	"""
 	psi_matrix_path = os.path.join(shiba_path, "results", "splicing", "PSI_matrix_sample.txt")
 	# Check if PSI matrix file exists
@@ -60,23 +64,114 @@ def get_psi_values(positional_id, shiba_path) -> dict:
 		raise FileNotFoundError(f"PSI matrix file not found: {psi_matrix_path}")
 		sys.exit(1)
 	# Load PSI matrix file
-	psi_values_dict = {}
-	with open(psi_matrix_path, "r") as psi_matrix:
-		for line in psi_matrix:
-			line = line.strip()
-			if not line or line.startswith("event_id"):
-				samples = line.split("\t")[2:]
-				continue
-			pos_id_in_file = line.split("\t")[1]
-			if pos_id_in_file == positional_id:
-				psi_values = line.split("\t")[2:]
-				for sample, psi in zip(samples, psi_values):
-					if psi.replace('.', '', 1).isdigit():
-						psi_values_dict[sample] = float(psi) * 100
-					else:
-						psi_values_dict[sample] = "NA"
-				break
-	if not psi_values_dict:
-		# PSI values are all NA
-		psi_values_dict = {sample: "NA" for sample in samples}
-	return psi_values_dict
+	header, lines_dict = utils.read_lines_by_key(psi_matrix_path, positional_ids, use_index=use_index)
+	samples = header.split("\t")[2:] if header else []
+	psi_values_by_id = {}
+	for positional_id in positional_ids:
+		if positional_id not in lines_dict:
+			# PSI values are all NA
+			psi_values_by_id[positional_id] = {sample: "NA" for sample in samples}
+			continue
+		psi_values_dict = {}
+		psi_values = lines_dict[positional_id].split("\t")[2:]
+		for sample, psi in zip(samples, psi_values):
+			if psi.replace('.', '', 1).isdigit():
+				psi_values_dict[sample] = float(psi) * 100
+			else:
+				psi_values_dict[sample] = "NA"
+		psi_values_by_id[positional_id] = psi_values_dict
+	return psi_values_by_id
+
+def get_psi_values(positional_id, shiba_path, use_index=True) -> dict:
+	"""
+	Load PSI values from PSI file
+
+	Parameters
+	- positional_id: str
+		Positional ID (e.g. SE@chr1:1000-2000)
+	- shiba_path: str
+		Path to Shiba output directory
+
+	Returns
+	- psi_values_dict: dict
+		Dictionary of PSI values
+		{sample: psi}
+	"""
+	return load_psi_values([positional_id], shiba_path, use_index)[positional_id]
+
+# Event types in differential splicing results of Shiba (results/splicing/PSI_<event type>.txt)
+EVENT_TYPES = ["SE", "FIVE", "THREE", "MXE", "RI", "MSE", "AFE", "ALE"]
+# Column names of q-value accepted in differential splicing results (case-insensitive)
+Q_VALUE_COLUMNS = ["q", "qvalue", "q_value", "fdr", "padj"]
+
+def parse_float(value):
+	"""
+	Return value as float, or None if it is NA or not a number.
+	"""
+	try:
+		value = float(value)
+	except ValueError:
+		return None
+	return None if value != value else value
+
+def load_differential_events(shiba_path, event_types = None, max_q = 0.05, min_dpsi = 0.1, rank_by = "q") -> list:
+	"""
+	Load significant events from differential splicing results of Shiba
+
+	Parameters
+	- shiba_path: str
+		Path to Shiba output directory
+	- event_types: list
+		Event types to load (default: all types in EVENT_TYPES whose result file exists)
+	- max_q, min_dpsi: float
+		Events with q-value <= max_q and |dPSI| >= min_dpsi are kept. Events with NA are skipped.
+	- rank_by: str
+		q (ascending q-value, then descending |dPSI|) or dpsi (descending |dPSI|, then ascending q-value)
+
+	Returns
+	- events: list
+		Ranked list of {pos_id, event_type, gene_name, dpsi, q}
+	"""
+	splicing_dir = os.path.join(shiba_path, "results", "splicing")
+	events = []
+	found = False
+	for event_type in (event_types or EVENT_TYPES):
+		result_path = os.path.join(splicing_dir, f"PSI_{event_type}.txt")
+		if not os.path.exists(result_path):
+			if event_types:
+				logger.warning(f"Differential splicing results not found: {result_path}")
+			continue
+		found = True
+		with open(result_path, "r") as results:
+			header = results.readline().rstrip("\n").split("\t")
+			columns = {name.lower(): i for i, name in enumerate(header)}
+			q_col = next((columns[name] for name in Q_VALUE_COLUMNS if name in columns), None)
+			if "pos_id" not in columns or "dpsi" not in columns or q_col is None:
+				logger.error(f"pos_id, dPSI or q-value column not found in {result_path}")
+				logger.error(f"Please provide differential splicing results of Shiba (q-value column: one of {', '.join(Q_VALUE_COLUMNS)})")
+				raise ValueError(f"pos_id, dPSI or q-value column not found in {result_path}")
+			pos_id_col, dpsi_col, gene_col = columns["pos_id"], columns["dpsi"], columns.get("gene_name")
+			for line in results:
+				cols = line.rstrip("\n").split("\t")
+				if len(cols) <= max(pos_id_col, dpsi_col, q_col):
+					continue
+				dpsi = parse_float(cols[dpsi_col])
+				q = parse_float(cols[q_col])
+				if dpsi is None or q is None or q > max_q or abs(dpsi) < min_dpsi:
+					continue
+				events.append({
+					"pos_id": cols[pos_id_col],
+					"event_type": event_type,
+					"gene_name": cols[gene_col] if gene_col is not None and gene_col < len(cols) else None,
+					"dpsi": dpsi,
+					"q": q
+				})
+	if not found:
+		logger.error(f"No differential splicing results found in {splicing_dir}")
+		logger.error("Please double check and provide a valid Shiba output directory")
+		raise FileNotFoundError(f"No differential splicing results found in {splicing_dir}")
+	if rank_by == "dpsi":
+		events.sort(key = lambda event: (-abs(event["dpsi"]), event["q"]))
+	else:
+		events.sort(key = lambda event: (event["q"], -abs(event["dpsi"])))
+	return events
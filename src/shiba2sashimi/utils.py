@@ -1,8 +1,182 @@
 import sys
 import os
+import hashlib
 import logging
 # Configure logging
 logger = logging.getLogger(__name__)
+import numpy as np
+
+# Version of sidecar index files. Increment when the format changes so that old indexes are rebuilt.
+INDEX_VERSION = 1
+# Suffix of sidecar index files of EVENT and PSI files
+LINE_INDEX_SUFFIX = ".s2s_index.npz"
+# Sidecar indexes loaded in this process, keyed by (source path, suffix), with signature of the source file
+_loaded_indexes = {}
+
+def file_signature(path) -> np.ndarray:
+	"""
+	Return signature (index version, size, and mtime) of a file to detect changes.
+	"""
+	stat = os.stat(path)
+	return np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def load_sidecar_index(source_path, suffix):
+	"""
+	Load sidecar index of source_path (source_path + suffix) as a dictionary of arrays.
+	Return None if the index does not exist or is outdated.
+	"""
+	index_path = source_path + suffix
+	if not os.path.exists(index_path):
+		return None
+	try:
+		with np.load(index_path, allow_pickle=False) as index:
+			arrays = {key: index[key] for key in index.files}
+	except (OSError, ValueError) as e:
+		logger.debug(f"Failed to load index {index_path}: {e}")
+		return None
+	if "signature" not in arrays or not np.array_equal(arrays["signature"], file_signature(source_path)):
+		logger.debug(f"Index is outdated: {index_path}")
+		return None
+	return arrays
+
+def load_cached_index(source_path, suffix, build):
+	"""
+	Return sidecar index of source_path, kept in memory for later calls in the same process (e.g. serve mode).
+	The index is loaded (or built by calling build) only on the first call or when the file has changed since.
+	"""
+	key = (os.path.abspath(source_path), suffix)
+	signature = file_signature(source_path)
+	if key in _loaded_indexes and np.array_equal(_loaded_indexes[key][0], signature):
+		return _loaded_indexes[key][1]
+	index = load_sidecar_index(source_path, suffix)
+	if index is None:
+		index = build()
+	_loaded_indexes[key] = (signature, index)
+	return index
+
+def save_sidecar_index(source_path, suffix, signature, arrays):
+	"""
+	Save sidecar index of source_path (source_path + suffix).
+	signature should be taken by file_signature before reading the source file.
+	Only a warning is logged if the index cannot be written (e.g. read-only directory).
+	"""
+	index_path = source_path + suffix
+	tmp_path = f"{index_path}.{os.getpid()}.tmp"
+	try:
+		with open(tmp_path, "wb") as index:
+			np.savez(index, signature=signature, **arrays)
+		os.replace(tmp_path, index_path)
+		logger.debug(f"Saved index: {index_path}")
+	except OSError as e:
+		logger.warning(f"Failed to save index {index_path}: {e}")
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+
+def hash_keys(keys) -> np.ndarray:
+	"""
+	Return stable 64-bit hashes of string keys (e.g. junction IDs or positional IDs).
+	"""
+	return np.array(
+		[int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") for key in keys],
+		dtype=np.uint64
+	)
+
+def lookup_hashed_offsets(index, key, hashes="hashes", offsets="offsets") -> list:
+	"""
+	Return byte offsets of lines whose key hash equals the hash of key in a sidecar index.
+	Lines should be checked by the caller as different keys may share the same hash.
+	"""
+	key_hash = hash_keys([key])[0]
+	lo = np.searchsorted(index[hashes], key_hash, side="left")
+	hi = np.searchsorted(index[hashes], key_hash, side="right")
+	return index[offsets][lo:hi].tolist()
+
+def build_line_index(path, key_col=1, header_prefix="event_id") -> dict:
+	"""
+	Build index of a tab-separated file mapping hash of the key column to byte offset of each line.
+
+	Returns
+	- index: dict
+		hashes, offsets: hash of key and byte offset of each line sorted by (hash, offset)
+		header_offset: byte offset of the header line
+	"""
+	logger.info(f"Building index of {path}")
+	signature = file_signature(path)
+	header_prefix = header_prefix.encode()
+	keys = []
+	offsets = []
+	header_offset = -1
+	with open(path, "rb") as f:
+		offset = 0
+		for line in f:
+			line_offset = offset
+			offset += len(line)
+			if line.startswith(header_prefix):
+				header_offset = line_offset
+				continue
+			cols = line.rstrip(b"\r\n").split(b"\t", key_col + 1)
+			if len(cols) <= key_col:
+				continue
+			keys.append(cols[key_col].decode())
+			offsets.append(line_offset)
+	hashes = hash_keys(keys)
+	offsets = np.array(offsets, dtype=np.int64)
+	order = np.lexsort((offsets, hashes))
+	index = {
+		"hashes": hashes[order],
+		"offsets": offsets[order],
+		"header_offset": np.array(header_offset, dtype=np.int64)
+	}
+	save_sidecar_index(path, LINE_INDEX_SUFFIX, signature, index)
+	return index
+
+def read_lines_by_key(path, keys, key_col=1, header_prefix="event_id", use_index=True) -> tuple:
+	"""
+	Read header and the first line matching each key in the key column of a tab-separated file.
+	With use_index, only the matching lines are read using the sidecar index (built if needed).
+	Otherwise, the file is scanned until all keys are found.
+
+	Returns
+	- header: str
+		Header line (None if not found)
+	- lines_dict: dict
+		{key: line}. Keys not found in the file are omitted.
+	"""
+	lines_dict = {}
+	header = None
+	if use_index:
+		index = load_cached_index(path, LINE_INDEX_SUFFIX, lambda: build_line_index(path, key_col, header_prefix))
+		with open(path, "rb") as f:
+			header_offset = int(index["header_offset"])
+			if header_offset >= 0:
+				f.seek(header_offset)
+				header = f.readline().decode().strip()
+			for key in set(keys):
+				for offset in lookup_hashed_offsets(index, key):
+					f.seek(offset)
+					line = f.readline().decode().strip()
+					# Different keys may share the same hash
+					if line.split("\t", key_col + 1)[key_col] == key:
+						lines_dict[key] = line
+						break
+		return header, lines_dict
+	remaining = set(keys)
+	with open(path, "r") as f:
+		for line in f:
+			line = line.strip()
+			if line.startswith(header_prefix):
+				header = line
+				continue
+			cols = line.split("\t", key_col + 1)
+			if len(cols) <= key_col:
+				continue
+			if cols[key_col] in remaining:
+				lines_dict[cols[key_col]] = line
+				remaining.discard(cols[key_col])
+				# Stop reading once all keys are found
+				if not remaining:
+					break
+	return header, lines_dict
 
 def coord2int(coordinate):
 	"""
@@ -24,43 +198,52 @@ def coord2int(coordinate):
 		sys.exit(1)
 	return chrom, start, end
 
-def posid2int(positional_id, shiba_path, extend_up, extend_down) -> tuple:
+def load_events(positional_ids, shiba_path, use_index=True) -> dict:
+	"""
+	Read EVENT files and return columns of each positional ID.
+	With use_index, only the lines of the requested events are read using the index of each EVENT file.
+	Otherwise, each EVENT file is scanned at most once, until all requested events are found.
+	"""
+	# Group positional IDs by event type
+	pos_ids_by_type = {}
+	for positional_id in positional_ids:
+		event_type = positional_id.split("@")[0]
+		pos_ids_by_type.setdefault(event_type, set()).add(positional_id)
+	events_dict = {}
+	for event_type, pos_ids in pos_ids_by_type.items():
+		# Get EVENT file path
+		event_file_path = os.path.join(shiba_path, "events", f"EVENT_{event_type}.txt")
+		# Check if EVENT file exists
+		if not os.path.exists(event_file_path):
+			logger.error(f"EVENT file not found: {event_file_path}")
+			logger.error("Please double check and provide a valid positional ID")
+			raise FileNotFoundError(f"EVENT file not found: {event_file_path}")
+			sys.exit(1)
+		# Read EVENT file
+		header, lines_dict = read_lines_by_key(event_file_path, pos_ids, use_index=use_index)
+		header_dict = {col: i for i, col in enumerate(header.split("\t"))} if header else {}
+		for pos_id_col, line in lines_dict.items():
+			# Get all columns and store in dictionary
+			columns = line.split("\t")
+			event_file_col_dict = {}
+			for col, i in header_dict.items():
+				try:
+					event_file_col_dict[col] = columns[i]
+				except:
+					event_file_col_dict[col] = None
+			events_dict[pos_id_col] = event_file_col_dict
+	return events_dict
+
+def posid2int(positional_id, shiba_path, extend_up, extend_down, event_file_col_dict = None, use_index = True) -> tuple:
 	"""
 	Get chromosome, start, and end of the target region and junction coordinates from positional ID.
+	Columns of the event can be given as event_file_col_dict (see load_events) to avoid reading EVENT file again.
 	"""
 	# Parse event type from positional ID (i.e. SE@chr10@20327164-20327391@20326099-20328102)
 	event_type = positional_id.split("@")[0] # (SE, FIVE, THREE, MXE, RI, AFE, ALE, MSE)
-	# Get EVENT file path
-	event_file_path = os.path.join(shiba_path, "events", f"EVENT_{event_type}.txt")
-	# Check if EVENT file exists
-	if not os.path.exists(event_file_path):
-		logger.error(f"EVENT file not found: {event_file_path}")
-		logger.error("Please double check and provide a valid positional ID")
-		raise FileNotFoundError(f"EVENT file not found: {event_file_path}")
-		sys.exit(1)
 	# Read EVENT file
-	event_file_col_dict = {}
-	header_dict = {}
-	with open(event_file_path, "r") as event_file:
-		for line in event_file:
-			line = line.strip()
-			# Skip header
-			if line.startswith("event_id"):
-				header = line.split("\t")
-				for i, col in enumerate(header):
-					header_dict[col] = i
-				continue
-			# Store values in dictionary if the 2nd column matches positional ID
-			pos_id_col = line.split("\t")[1]
-			if pos_id_col == positional_id:
-				# Get all columns and store in dictionary
-				columns = line.split("\t")
-				for col, i in header_dict.items():
-					try:
-						event_file_col_dict[col] = columns[i]
-					except:
-						event_file_col_dict[col] = None
-				break
+	if event_file_col_dict is None:
+		event_file_col_dict = load_events([positional_id], shiba_path, use_index).get(positional_id, {})
 	# Check if positional ID exists in EVENT file
 	if not event_file_col_dict:
 		logger.error(f"Positional ID not found in EVENT file: {positional_id}")